@@ -13,9 +13,9 @@
 # limitations under the License.
 
 # This class contains the basic functionality needed to format code
-import re
 from .. import mparser
 from . import AstVisitor
+from functools import lru_cache
 import typing as T
 
 arithmic_map = {
@@ -26,18 +26,67 @@ arithmic_map = {
     'div': '/'
 }
 
-class AstFormatter(AstVisitor):
+_PADDED_ARITHMETIC = {k: f' {v} ' for k, v in arithmic_map.items()}
+_PADDED_COMPARISON = {k: f' {k} ' for k in mparser.comparison_map.values()}
+_PADDED_COMPARISON['notin'] = ' not in '
+
+_ESCAPE_TABLE = str.maketrans({'\'': '\\\'',
+                               '\\': '\\\\',
+                               '\n': '\\n'})
+
+# Build files repeat the same strings a lot (option and dependency names,
+# file extensions, ...), so remember the escaped form of recent ones.
+@lru_cache(maxsize=4096)
+def _escape(val: str) -> str:
+    return val.translate(_ESCAPE_TABLE)
+
+class _FormatterBase(AstVisitor):
+    # What AstFormatter and AstFormatter2 share
+    __slots__ = ()
+
+    def _emit(self, node: mparser.BaseNode) -> None:
+        raise NotImplementedError
+
+    def append(self, to_append: str) -> None:
+        raise NotImplementedError
+
+    def escape(self, val: str) -> str:
+        return _escape(val)
+
+    def _emit_operator_chain(self, node: T.Union[mparser.OrNode, mparser.AndNode, mparser.ArithmeticNode],
+                             operator: T.Optional[str]) -> None:
+        # Left associative operators like 'a + b + c' produce left-deep trees.
+        # Walk down the left spine with a loop so that long chains don't cost
+        # two nested visitor calls per operator. Without a fixed operator
+        # this is an arithmetic chain, which can mix operators.
+        chain = []  # type: T.List[T.Any]
+        left = node  # type: T.Any
+        while type(left) is type(node):
+            chain.append(left)
+            left = left.left
+        self._emit(left)
+        for i in reversed(chain):
+            self.append(operator if operator is not None else _PADDED_ARITHMETIC[i.operation])
+            self._emit(i.right)
+
+class AstFormatter(_FormatterBase):
+    __slots__ = ('lines', 'indentstr', 'currindent', 'currline', 'currlen', 'comments',
+                 'old_lines', 'config', 'last_line_cache', '_dispatch')
+
     def __init__(self, comments: T.List[mparser.Comment], lines: T.List[str], config):
         self.lines = []
         self.indentstr = config['indent_by']
         self.currindent = ''
-        self.currline = ''
+        self.currline = []  # type: T.List[str]
+        self.currlen = 0
         self.comments = comments
         self.old_lines = lines
         self.config = config
+        self.last_line_cache = {}  # type: T.Dict[mparser.BaseNode, int]
+        self._dispatch = self.build_dispatch_table()
 
     def end(self):
-        self.lines.append(self.currline)
+        self.lines.append(''.join(self.currline))
         for i, l in enumerate(self.lines):
             if l.strip() == '':
                 self.lines[i] = ''
@@ -68,13 +117,25 @@ class AstFormatter(AstVisitor):
                 self.lines.append(self.comments[idx].text)
                 del self.comments[idx]
 
+    def _emit(self, node: mparser.BaseNode) -> None:
+        self._dispatch[type(node)](node)
+
     def append(self, to_append):
-        self.currline += to_append
+        self.currline.append(to_append)
+        self.currlen += len(to_append)
+
+    def set_line(self, text: str):
+        self.currline = [text]
+        self.currlen = len(text)
+
+    def reset_line(self):
+        self.set_line(self.currindent)
 
     def force_linebreak(self):
-        if self.currline.strip() != '':
-            self.lines.append(self.currline)
-            self.currline = self.currindent
+        line = ''.join(self.currline)
+        if line.strip() != '':
+            self.lines.append(line)
+            self.reset_line()
 
     def get_length(self, node: mparser.BaseNode):
         add_extra = 0
@@ -176,7 +237,7 @@ class AstFormatter(AstVisitor):
     def check_post_comment(self, node: mparser.BaseNode):
         to_readd = None
         idx = 0
-        last_line = AstFormatter.extract_last_line(node)
+        last_line = self.extract_last_line(node)
         for c in self.comments:
             if c.lineno == last_line + 1 and self.old_lines[c.lineno - 1].strip().startswith('#'):
                 to_readd = c
@@ -192,7 +253,7 @@ class AstFormatter(AstVisitor):
             del self.comments[idx]
 
     def eventual_linebreak(self):
-        if len(self.currline.strip()) != 0:
+        if len(''.join(self.currline).strip()) != 0:
             self.force_linebreak()
 
     def visit_BooleanNode(self, node: mparser.BooleanNode) -> None:
@@ -205,14 +266,9 @@ class AstFormatter(AstVisitor):
     def visit_NumberNode(self, node: mparser.NumberNode) -> None:
         self.append(str(node.value))
 
-    def escape(self, val: str) -> str:
-        return val.translate(str.maketrans({'\'': '\\\'',
-                                            '\\': '\\\\',
-                                            '\n': '\\n'}))
-
     def visit_StringNode(self, node: mparser.StringNode) -> None:
         assert isinstance(node.value, str)
-        self.append("'" + self.escape(node.value) + "'")
+        self.append("'" + _escape(node.value) + "'")
 
     def visit_FormatStringNode(self, node: mparser.FormatStringNode) -> None:
         assert isinstance(node.value, str)
@@ -233,39 +289,33 @@ class AstFormatter(AstVisitor):
         num_elements = len(node.args.arguments)
         if self.config['space_array'] and num_elements != 0:
             self.append(' ')
-        node.args.accept(self)
+        self._emit(node.args)
         if self.config['space_array'] and num_elements != 0:
             self.append(' ')
         self.append(']')
 
     def visit_DictNode(self, node: mparser.DictNode) -> None:
         self.append('{')
-        node.args.accept(self)
+        self._emit(node.args)
         self.append('}')
 
     def visit_OrNode(self, node: mparser.OrNode) -> None:
-        node.left.accept(self)
-        self.append(' or ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, ' or ')
 
     def visit_AndNode(self, node: mparser.AndNode) -> None:
-        node.left.accept(self)
-        self.append(' and ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, ' and ')
 
     def visit_ComparisonNode(self, node: mparser.ComparisonNode) -> None:
-        node.left.accept(self)
-        self.append(' ' + (node.ctype if node.ctype != 'notin' else 'not in') + ' ')
-        node.right.accept(self)
+        self._emit(node.left)
+        self.append(_PADDED_COMPARISON[node.ctype])
+        self._emit(node.right)
 
     def visit_ArithmeticNode(self, node: mparser.ArithmeticNode) -> None:
-        node.left.accept(self)
-        self.append(' ' + arithmic_map[node.operation] + ' ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, None)
 
     def visit_NotNode(self, node: mparser.NotNode) -> None:
         self.append('not ')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_CodeBlockNode(self, node: mparser.CodeBlockNode) -> None:
         idx = 0
@@ -274,12 +324,12 @@ class AstFormatter(AstVisitor):
         for i in node.lines:
             if lastline != -1:
                 if i.lineno > lastline + 1 and self.old_lines[lastline + 1].strip() != ')':
-                    self.lines.append(self.currline)
-                    self.currline = self.currindent
+                    self.lines.append(''.join(self.currline))
+                    self.reset_line()
             self.check_comment(i)
-            i.accept(self)
+            self._emit(i)
             self.check_adjacent_comment(i, '')
-            lastline = AstFormatter.extract_last_line(i)
+            lastline = self.extract_last_line(i)
             idx += 1
             if i != len(node.lines) - 1:
                 self.force_linebreak()
@@ -287,11 +337,11 @@ class AstFormatter(AstVisitor):
             self.check_post_comment(node.lines[len(node.lines) - 1])
 
     def visit_IndexNode(self, node: mparser.IndexNode) -> None:
-        node.iobject.accept(self)
+        self._emit(node.iobject)
         self.append('[')
         if self.config['space_array']:
             self.append(' ')
-        node.index.accept(self)
+        self._emit(node.index)
         if self.config['space_array']:
             self.append(' ')
         self.append(']')
@@ -313,8 +363,8 @@ class AstFormatter(AstVisitor):
                 estimated_len = len(str(arg.value))
             elif isinstance(arg, mparser.MethodNode) and isinstance(arg.source_object, mparser.StringNode):
                 estimated_len = len(arg.source_object.value) + 2 + len(arg.name)
-            if len(args.arguments) + len(args.kwargs) != 1 or len(self.currline) + estimated_len > self.config['max_line_len']:
-                if len(self.currline) > self.config['max_line_len']:
+            if len(args.arguments) + len(args.kwargs) != 1 or self.currlen + estimated_len > self.config['max_line_len']:
+                if self.currlen > self.config['max_line_len']:
                     self.force_linebreak()
                     n_linebreaks += 1
                     broke_up = True
@@ -331,7 +381,7 @@ class AstFormatter(AstVisitor):
             if isinstance(arg, mparser.ArrayNode) and len(args.arguments) == 1:
                 self.visit_ArrayNodeAssignment(arg)
             else:
-                arg.accept(self)
+                self._emit(arg)
             if i != len(args.arguments) - 1 or len(args.kwargs) != 0:
                 self.currindent = ' ' * indent_len
                 self.append(',')
@@ -361,7 +411,7 @@ class AstFormatter(AstVisitor):
             if isinstance(kw, mparser.ArrayNode) and (len(kw.args.arguments) != 0 or kw.lineno < kw.end_lineno):
                 self.visit_ArrayNodeAssignment(kw)
             else:
-                kw.accept(self)
+                self._emit(kw)
             if n_linebreaks != 0 or i < len(args.kwargs) - 1:
                 self.append(',')
             if broke_up or broke_up_total:
@@ -383,24 +433,24 @@ class AstFormatter(AstVisitor):
             self.force_linebreak()
 
     def visit_MethodNode(self, node: mparser.MethodNode) -> None:
-        node.source_object.accept(self)
+        self._emit(node.source_object)
         self.append('.' + node.name + '(')
-        if len(node.args.arguments) != 0 or len(node.args.kwargs) != 0:
-            args = node.args
+        args = node.args
+        if args.arguments or args.kwargs:
             self.visit_ArgumentsCall(args)
         self.append(')')
 
     def visit_FunctionNode(self, node: mparser.FunctionNode) -> None:
         self.append(node.func_name + '(')
-        if len(node.args.arguments) != 0 or len(node.args.kwargs) != 0:
-            args = node.args
+        args = node.args
+        if args.arguments or args.kwargs:
             self.visit_ArgumentsCall(args)
         self.append(')')
 
     def visit_ArrayNodeAssignment(self, node: mparser.ArrayNode) -> None:
         assert isinstance(node, mparser.ArrayNode)
         if len(node.args.arguments) == 1 and node.lineno == node.end_lineno:
-            node.accept(self)
+            self._emit(node)
             return
         self.append('[')
         tmp = self.currindent
@@ -411,11 +461,11 @@ class AstFormatter(AstVisitor):
             copy = mparser.ArrayNode(node.args, node.lineno, node.colno, node.lineno, node.colno)
             copy.end_lineno = copy.lineno
             self.check_post_comment(copy)
-            self.currline = self.currline[len(self.indentstr):]
+            self.set_line(''.join(self.currline)[len(self.indentstr):])
         for i, e in enumerate(node.args.arguments):
             self.currindent = tmp + self.indentstr
             self.check_comment(e)
-            e.accept(self)
+            self._emit(e)
             self.check_adjacent_comment(e, ',')
             if i == len(node.args.arguments) - 1:
                 self.currindent = tmp
@@ -447,11 +497,11 @@ class AstFormatter(AstVisitor):
         for i, e in enumerate(node.args.kwargs):
             self.currindent = tmp + self.indentstr
             self.check_comment(e)
-            e.accept(self)
+            self._emit(e)
             if wide_colon:
                 self.append(' ' * (align - self.get_length(e) + 1))
             self.append(': ')
-            node.args.kwargs[e].accept(self)
+            self._emit(node.args.kwargs[e])
             self.check_adjacent_comment(e, ',')
             if i == len(node.args.kwargs) - 1:
                 self.currindent = tmp
@@ -467,7 +517,7 @@ class AstFormatter(AstVisitor):
         elif isinstance(node.value, mparser.DictNode) and len(node.value.args.kwargs) != 0:
             self.visit_DictNodeAssignment(node.value)
         else:
-            node.value.accept(self)
+            self._emit(node.value)
 
     def visit_PlusAssignmentNode(self, node: mparser.PlusAssignmentNode) -> None:
         self.append(node.var_name + ' += ')
@@ -476,15 +526,14 @@ class AstFormatter(AstVisitor):
         elif isinstance(node.value, mparser.DictNode) and len(node.value.args.kwargs) != 0:
             self.visit_DictNodeAssignment(node.value)
         else:
-            node.value.accept(self)
+            self._emit(node.value)
 
     def visit_ForeachClauseNode(self, node: mparser.ForeachClauseNode) -> None:
         self.eventual_linebreak()
-        varnames = list(node.varnames)
         tmp = self.currindent
         self.check_comment(node)
         self.append('foreach ')
-        self.append(', '.join(varnames))
+        self.append(', '.join(node.varnames))
         self.append(' : ')
         if isinstance(node.items, mparser.ArrayNode) and (len(node.items.args.arguments) != 0 or node.items.lineno < node.items.end_lineno):
             self.currindent += self.indentstr
@@ -495,13 +544,13 @@ class AstFormatter(AstVisitor):
             self.visit_DictNodeAssignment(node.items)
             self.currindent = tmp
         else:
-            node.items.accept(self)
+            self._emit(node.items)
         self.currindent += self.indentstr
         self.force_linebreak()
-        node.block.accept(self)
+        self._emit(node.block)
         self.currindent = tmp
         self.force_linebreak()
-        self.currline = self.currindent
+        self.reset_line()
         self.append('endforeach')
 
     def visit_IfClauseNode(self, node: mparser.IfClauseNode) -> None:
@@ -510,72 +559,84 @@ class AstFormatter(AstVisitor):
         for i in node.ifs:
             self.check_comment(i)
             self.currindent = tmp
-            self.currline = self.currindent
+            self.reset_line()
             self.append(prefix + 'if ')
             prefix = 'el'
-            i.accept(self)
+            self._emit(i)
             self.currindent = tmp
-            self.currline = self.currindent
-        if not isinstance(node.elseblock, mparser.EmptyNode):
+            self.reset_line()
+        if type(node.elseblock) is not mparser.EmptyNode:
             self.check_comment(node.elseblock)
             self.append('else')
             self.currindent += self.indentstr
             self.force_linebreak()
-            node.elseblock.accept(self)
+            self._emit(node.elseblock)
             self.currindent = tmp
             self.force_linebreak()
         self.currindent = tmp
-        self.currline = self.currindent
+        self.reset_line()
         self.append('endif')
 
-    @staticmethod
-    def extract_last_line(node: mparser.BaseNode) -> int:
+    def extract_last_line(self, node: mparser.BaseNode) -> int:
+        # This is queried for every line of every code block, so without the
+        # cache nested blocks would be walked again for each enclosing block.
+        last_line = self.last_line_cache.get(node)
+        if last_line is None:
+            last_line = self.compute_last_line(node)
+            self.last_line_cache[node] = last_line
+        return last_line
+
+    def compute_last_line(self, node: mparser.BaseNode) -> int:
         if isinstance(node, mparser.IfClauseNode):
-            if not isinstance(node.elseblock, mparser.EmptyNode):
-                return AstFormatter.extract_last_line(node.elseblock) + 1
-            return AstFormatter.extract_last_line(node.ifs[-1].block) + 1
+            if type(node.elseblock) is not mparser.EmptyNode:
+                return self.extract_last_line(node.elseblock) + 1
+            return self.extract_last_line(node.ifs[-1].block) + 1
         elif isinstance(node, mparser.ForeachClauseNode):
-            return AstFormatter.extract_last_line(node.block) + 1
+            return self.extract_last_line(node.block) + 1
         elif isinstance(node, mparser.CodeBlockNode):
             if len(node.lines) != 0:
-                return max(AstFormatter.extract_last_line(node.lines[-1]), node.end_lineno)
+                return max(self.extract_last_line(node.lines[-1]), node.end_lineno)
         elif isinstance(node, (mparser.AssignmentNode, mparser.PlusAssignmentNode)):
-            return AstFormatter.extract_last_line(node.value)
+            return self.extract_last_line(node.value)
         elif isinstance(node, mparser.MethodNode):
-            return AstFormatter.extract_last_line(node.args)
+            return self.extract_last_line(node.args)
         elif isinstance(node, mparser.ArgumentNode):
             max_line = node.end_lineno
             for arg in node.arguments:
-                max_line = max(max_line, AstFormatter.extract_last_line(arg))
+                max_line = max(max_line, self.extract_last_line(arg))
             for key, val in node.kwargs.items():
-                max_line = max(max_line, AstFormatter.extract_last_line(val))
+                max_line = max(max_line, self.extract_last_line(val))
             return max_line
         return node.end_lineno
 
     def visit_UMinusNode(self, node: mparser.UMinusNode) -> None:
         self.append('-')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_IfNode(self, node: mparser.IfNode) -> None:
         self.check_comment(node)
-        node.condition.accept(self)
+        self._emit(node.condition)
         tmp = self.currindent
         self.currindent += self.indentstr
         self.force_linebreak()
-        node.block.accept(self)
+        self._emit(node.block)
         self.currindent = tmp
 
     def visit_TernaryNode(self, node: mparser.TernaryNode) -> None:
-        node.condition.accept(self)
+        self._emit(node.condition)
         self.append(' ? ')
-        node.trueblock.accept(self)
+        self._emit(node.trueblock)
         self.append(' : ')
-        node.falseblock.accept(self)
+        self._emit(node.falseblock)
 
     def visit_ArgumentNode(self, node: mparser.ArgumentNode) -> None:
+        # Long argument lists are the hottest loop of the formatter, so use the
+        # bound methods directly instead of looking them up for every element.
+        dispatch = self._dispatch
+        append = self.append
         for i in node.arguments:
-            i.accept(self)
-            self.append(', ')
+            dispatch[type(i)](i)
+            append(', ')
         wide_colon = self.config['wide_colon']
         tmp = self.currindent
         self.currindent += self.indentstr
@@ -583,12 +644,12 @@ class AstFormatter(AstVisitor):
         for key, val in node.kwargs.items():
             self.force_linebreak()
             self.check_comment(key)
-            key.accept(self)
+            self._emit(key)
             if not wide_colon:
                 self.append(': ')
             else:
                 self.append(' : ')
-            val.accept(self)
+            self._emit(val)
             if idx == len(node.kwargs) - 1:
                 self.currindent = tmp
                 self.force_linebreak()
@@ -596,9 +657,11 @@ class AstFormatter(AstVisitor):
                 self.append(',')
             idx += 1
         self.currindent = tmp
-        self.currline = re.sub(r', $', '', self.currline)
+        if self.currline and self.currline[-1] == ', ':
+            self.currline.pop()
+            self.currlen -= 2
 
     def visit_ParenthesizedNode(self, node: mparser.ParenthesizedNode) -> None:
         self.append('(')
-        node.inner.accept(self)
+        self._emit(node.inner)
         self.append(')')
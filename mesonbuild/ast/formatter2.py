@@ -13,64 +13,97 @@
 # limitations under the License.
 
 # This class contains the basic functionality needed to format code
-import re
 from .. import mparser
-from . import AstVisitor
+from .formatter import _FormatterBase, _PADDED_COMPARISON, _escape
 import typing as T
 
-arithmic_map = {
-    'add': '+',
-    'sub': '-',
-    'mod': '%',
-    'mul': '*',
-    'div': '/'
-}
-
-class AstFormatter2(AstVisitor):
-    def __init__(self,  lines: T.List[str], config):
-        self.lines = []
-        self.indentstr = config['indent_by']
+# Literals are always rendered the same way, independent of the indentation
+# and line breaking state of the formatter, so they are plain functions
+# returning the text instead of visitor methods mutating the current line.
+def _render_boolean(node: mparser.BooleanNode) -> str:
+    return 'true' if node.value else 'false'
+
+def _render_id(node: mparser.IdNode) -> str:
+    return node.value
+
+def _render_number(node: mparser.NumberNode) -> str:
+    return str(node.value)
+
+def _render_string(node: mparser.StringNode) -> str:
+    return "'" + _escape(node.value) + "'"
+
+def _render_format_string(node: mparser.FormatStringNode) -> str:
+    return "f'" + node.value + "'"
+
+_LEAF_RENDERERS = {
+    mparser.BooleanNode: _render_boolean,
+    mparser.IdNode: _render_id,
+    mparser.NumberNode: _render_number,
+    mparser.StringNode: _render_string,
+    mparser.FormatStringNode: _render_format_string,
+}  # type: T.Dict[T.Type[mparser.BaseNode], T.Callable[[T.Any], str]]
+
+class AstFormatter2(_FormatterBase):
+    __slots__ = ('lines', 'indentstr', 'indents', 'depth', 'currindent', 'currline',
+                 'content_fragments', 'old_lines', 'config', '_dispatch')
+
+    def __init__(self, lines: T.List[str], config: T.Dict[str, T.Any]):
+        self.lines = []  # type: T.List[str]
+        self.indentstr = config['indent_by']  # type: str
+        # Indentation strings by nesting depth, extended on demand
+        self.indents = ['']
+        self.depth = 0
         self.currindent = ''
-        self.currline = ''
+        self.currline = []  # type: T.List[str]
+        # Number of fragments in currline that are not just whitespace, so
+        # that whitespace only lines can be detected without joining them.
+        self.content_fragments = 0
         self.old_lines = lines
         self.config = config
+        self._dispatch = self.build_dispatch_table()
 
-    def end(self):
-        self.lines.append(self.currline)
-        for i, l in enumerate(self.lines):
-            if l.strip() == '':
-                self.lines[i] = ''
+    def end(self) -> None:
+        # force_linebreak() never stores whitespace only lines, so only the
+        # last line has to be checked.
+        self.lines.append(''.join(self.currline) if self.content_fragments else '')
 
-    def append(self, to_append):
-        self.currline += to_append
+    def _emit(self, node: mparser.BaseNode) -> None:
+        self._dispatch[type(node)](node)
 
-    def force_linebreak(self):
-        if self.currline.strip() != '':
-            self.lines.append(self.currline)
-            self.currline = self.currindent
+    def append(self, to_append: str) -> None:
+        self.currline.append(to_append)
+        if to_append and not to_append.isspace():
+            self.content_fragments += 1
+
+    def reset_line(self) -> None:
+        self.currline = [self.currindent]
+        self.content_fragments = 1 if self.currindent and not self.currindent.isspace() else 0
+
+    def set_depth(self, depth: int) -> None:
+        while len(self.indents) <= depth:
+            self.indents.append(self.indents[-1] + self.indentstr)
+        self.depth = depth
+        self.currindent = self.indents[depth]
+
+    def force_linebreak(self) -> None:
+        if self.content_fragments:
+            self.lines.append(''.join(self.currline))
+            self.reset_line()
 
     def visit_BooleanNode(self, node: mparser.BooleanNode) -> None:
-        self.append('true' if node.value else 'false')
+        self.append(_render_boolean(node))
 
     def visit_IdNode(self, node: mparser.IdNode) -> None:
-        assert isinstance(node.value, str)
-        self.append(node.value)
+        self.append(_render_id(node))
 
     def visit_NumberNode(self, node: mparser.NumberNode) -> None:
-        self.append(str(node.value))
-
-    def escape(self, val: str) -> str:
-        return val.translate(str.maketrans({'\'': '\\\'',
-                                            '\\': '\\\\',
-                                            '\n': '\\n'}))
+        self.append(_render_number(node))
 
     def visit_StringNode(self, node: mparser.StringNode) -> None:
-        assert isinstance(node.value, str)
-        self.append("'" + self.escape(node.value) + "'")
+        self.append(_render_string(node))
 
     def visit_FormatStringNode(self, node: mparser.FormatStringNode) -> None:
-        assert isinstance(node.value, str)
-        self.append("f'" + node.value + "'")
+        self.append(_render_format_string(node))
 
     def visit_ContinueNode(self, node: mparser.ContinueNode) -> None:
         self.force_linebreak()
@@ -87,163 +120,167 @@ class AstFormatter2(AstVisitor):
         num_elements = len(node.args.arguments)
         if self.config['space_array'] and num_elements != 0:
             self.append(' ')
-        node.args.accept(self)
+        self._emit(node.args)
         if self.config['space_array'] and num_elements != 0:
             self.append(' ')
         self.append(']')
 
     def visit_DictNode(self, node: mparser.DictNode) -> None:
         self.append('{')
-        node.args.accept(self)
+        self._emit(node.args)
         self.append('}')
 
     def visit_OrNode(self, node: mparser.OrNode) -> None:
-        node.left.accept(self)
-        self.append(' or ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, ' or ')
 
     def visit_AndNode(self, node: mparser.AndNode) -> None:
-        node.left.accept(self)
-        self.append(' and ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, ' and ')
 
     def visit_ComparisonNode(self, node: mparser.ComparisonNode) -> None:
-        node.left.accept(self)
-        self.append(' ' + (node.ctype if node.ctype != 'notin' else 'not in') + ' ')
-        node.right.accept(self)
+        self._emit(node.left)
+        self.append(_PADDED_COMPARISON[node.ctype])
+        self._emit(node.right)
 
     def visit_ArithmeticNode(self, node: mparser.ArithmeticNode) -> None:
-        node.left.accept(self)
-        self.append(' ' + arithmic_map[node.operation] + ' ')
-        node.right.accept(self)
+        self._emit_operator_chain(node, None)
 
     def visit_NotNode(self, node: mparser.NotNode) -> None:
         self.append('not ')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_CodeBlockNode(self, node: mparser.CodeBlockNode) -> None:
-        idx = 0
+        dispatch = self._dispatch
+        force_linebreak = self.force_linebreak
         for i in node.lines:
-            i.accept(self)
-            self.force_linebreak()
-            idx += 1
+            dispatch[type(i)](i)
+            force_linebreak()
 
     def visit_IndexNode(self, node: mparser.IndexNode) -> None:
-        node.iobject.accept(self)
+        self._emit(node.iobject)
         self.append('[')
         if self.config['space_array']:
             self.append(' ')
-        node.index.accept(self)
+        self._emit(node.index)
         if self.config['space_array']:
             self.append(' ')
         self.append(']')
 
     def visit_MethodNode(self, node: mparser.MethodNode) -> None:
-        node.source_object.accept(self)
+        self._emit(node.source_object)
         self.append('.' + node.name + '(')
-        if len(node.args.arguments) != 0 or len(node.args.kwargs) != 0:
-            args = node.args
-            args.accept(self)
+        args = node.args
+        if args.arguments or args.kwargs:
+            self._emit(args)
         self.append(')')
 
     def visit_FunctionNode(self, node: mparser.FunctionNode) -> None:
         self.append(node.func_name + '(')
-        if len(node.args.arguments) != 0 or len(node.args.kwargs) != 0:
-            args = node.args
-            args.accept(self)
+        args = node.args
+        if args.arguments or args.kwargs:
+            self._emit(args)
         self.append(')')
 
     def visit_AssignmentNode(self, node: mparser.AssignmentNode) -> None:
         self.append(node.var_name + ' = ')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_PlusAssignmentNode(self, node: mparser.PlusAssignmentNode) -> None:
         self.append(node.var_name + ' += ')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_UMinusNode(self, node: mparser.UMinusNode) -> None:
         self.append('-')
-        node.value.accept(self)
+        self._emit(node.value)
 
     def visit_IfNode(self, node: mparser.IfNode) -> None:
-        node.condition.accept(self)
-        tmp = self.currindent
-        self.currindent += self.indentstr
+        self._emit(node.condition)
+        depth = self.depth
+        self.set_depth(self.depth + 1)
         self.force_linebreak()
-        node.block.accept(self)
-        self.currindent = tmp
+        self._emit(node.block)
+        self.set_depth(depth)
 
     def visit_ForeachClauseNode(self, node: mparser.ForeachClauseNode) -> None:
-        varnames = list(node.varnames)
-        tmp = self.currindent
+        depth = self.depth
         self.append('foreach ')
-        self.append(', '.join(varnames))
+        self.append(', '.join(node.varnames))
         self.append(' : ')
-        node.items.accept(self)
-        self.currindent += self.indentstr
+        self._emit(node.items)
+        self.set_depth(self.depth + 1)
         self.force_linebreak()
-        node.block.accept(self)
-        self.currindent = tmp
+        self._emit(node.block)
+        self.set_depth(depth)
         self.force_linebreak()
-        self.currline = self.currindent
+        self.reset_line()
         self.append('endforeach')
 
     def visit_IfClauseNode(self, node: mparser.IfClauseNode) -> None:
         prefix = ''
-        tmp = self.currindent
+        depth = self.depth
         for i in node.ifs:
-            self.currindent = tmp
-            self.currline = self.currindent
+            self.set_depth(depth)
+            self.reset_line()
             self.append(prefix + 'if ')
             prefix = 'el'
-            i.accept(self)
-            self.currindent = tmp
-            self.currline = self.currindent
-        if not isinstance(node.elseblock, mparser.EmptyNode):
+            self._emit(i)
+            self.set_depth(depth)
+            self.reset_line()
+        if type(node.elseblock) is not mparser.EmptyNode:
             self.append('else')
-            self.currindent += self.indentstr
+            self.set_depth(self.depth + 1)
             self.force_linebreak()
-            node.elseblock.accept(self)
-            self.currindent = tmp
+            self._emit(node.elseblock)
+            self.set_depth(depth)
             self.force_linebreak()
-        self.currindent = tmp
-        self.currline = self.currindent
+        self.set_depth(depth)
+        self.reset_line()
         self.append('endif')
         self.force_linebreak()
 
     def visit_TernaryNode(self, node: mparser.TernaryNode) -> None:
-        node.condition.accept(self)
+        self._emit(node.condition)
         self.append(' ? ')
-        node.trueblock.accept(self)
+        self._emit(node.trueblock)
         self.append(' : ')
-        node.falseblock.accept(self)
+        self._emit(node.falseblock)
 
     def visit_ArgumentNode(self, node: mparser.ArgumentNode) -> None:
+        # Long argument lists are the hottest loop of the formatter, so use the
+        # bound methods directly instead of looking them up for every element,
+        # and render literals, the most common arguments, without a visitor.
+        dispatch = self._dispatch
+        append = self.append
         for i in node.arguments:
-            i.accept(self)
-            self.append(', ')
+            render = _LEAF_RENDERERS.get(type(i))
+            if render is not None:
+                append(render(i))
+            else:
+                dispatch[type(i)](i)
+            append(', ')
         wide_colon = self.config['wide_colon']
-        tmp = self.currindent
-        self.currindent += self.indentstr
+        depth = self.depth
+        self.set_depth(self.depth + 1)
         idx = 0
         for key, val in node.kwargs.items():
             self.force_linebreak()
-            key.accept(self)
+            self._emit(key)
             if not wide_colon:
                 self.append(': ')
             else:
                 self.append(' : ')
-            val.accept(self)
+            self._emit(val)
             if idx == len(node.kwargs) - 1:
-                self.currindent = tmp
+                self.set_depth(depth)
                 self.force_linebreak()
             else:
                 self.append(',')
             idx += 1
-        self.currindent = tmp
-        self.currline = re.sub(r', $', '', self.currline)
+        self.set_depth(depth)
+        if self.currline and self.currline[-1] == ', ':
+            self.currline.pop()
+            self.content_fragments -= 1
 
     def visit_ParenthesizedNode(self, node: mparser.ParenthesizedNode) -> None:
         self.append('(')
-        node.inner.accept(self)
+        self._emit(node.inner)
         self.append(')')
@@ -18,13 +18,30 @@ from __future__ import annotations
 
 import typing as T
 
-if T.TYPE_CHECKING:
-    from .. import mparser
+from .. import mparser
+
+def _ignore_node(node: mparser.BaseNode) -> None:
+    pass
 
 class AstVisitor:
+    # Empty, so that subclasses can opt into __slots__
+    __slots__ = ()
+
     def __init__(self) -> None:
         pass
 
+    def build_dispatch_table(self) -> T.Dict[T.Type[mparser.BaseNode], T.Callable[[T.Any], None]]:
+        # Maps every node type to the bound method BaseNode.accept() would call
+        # for it, so hot visitors can dispatch with a single dict lookup.
+        table = {}  # type: T.Dict[T.Type[mparser.BaseNode], T.Callable[[T.Any], None]]
+        todo = [mparser.BaseNode]  # type: T.List[T.Type[mparser.BaseNode]]
+        while todo:
+            cls = todo.pop()
+            todo += cls.__subclasses__()
+            func = getattr(self, cls.visit_name, None)
+            table[cls] = func if callable(func) else _ignore_node
+        return table
+
     def visit_default_func(self, node: mparser.BaseNode) -> None:
         pass
 
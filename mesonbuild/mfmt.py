@@ -1,6 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import argparse
+import hashlib
+import itertools
 import os
+import queue
 import sys
+import threading
+import typing as T
 from . import coredata, mparser
 from . import mesonlib
 from .ast import AstFormatter, AstFormatter2
@@ -15,6 +22,9 @@ def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('-R', '--recurse', action='store_true', help='Recursively format meson files in a given directory')
     parser.add_argument('-q', '--quiet', action='store_true', help='Don\'t print comments that couldn\'t be readded')
     parser.add_argument('-v', '--verbose', action='store_true', help='Don\'t print comments that couldn\'t be readded')
+    parser.add_argument('--cache', action='store_true',
+                        help='Reuse the output for files that were formatted before. '
+                             'Files found in the cache are not parsed again, so their warnings are not shown.')
 
 def parse_fmt_config(file: str):
     config = {}
@@ -48,25 +58,165 @@ def parse_fmt_config(file: str):
                     print("Unknown key", key, file=sys.stderr)
     return config
 
-def format_code(options: argparse.Namespace, file: str, output: str, code: str) -> int:
+# The cache keeps the most recently used entries, older ones are removed
+CACHE_MAX_ENTRIES = 1024
+
+@lru_cache(maxsize=None)
+def formatter_digest() -> bytes:
+    # Hash the sources of everything that changes the output, so that a
+    # modified formatter doesn't reuse stale results. Frozen builds have no
+    # sources, but then the version is enough.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(coredata.version.encode('utf-8'))
+    root = Path(__file__).parent
+    for name in ('mfmt.py', 'mparser.py', 'ast/formatter.py', 'ast/formatter2.py'):
+        try:
+            h.update((root / name).read_bytes())
+        except OSError:
+            pass
+    return h.digest()
+
+def cache_dir() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(cache_home, 'meson', 'fmt')
+
+def cache_path(code: str, config: T.Dict[str, T.Any]) -> Path:
+    # The output only depends on the input, the configuration and the
+    # formatter itself, so all of them are part of the key.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(formatter_digest())
+    h.update(repr(sorted(config.items())).encode('utf-8'))
+    h.update(code.encode('utf-8'))
+    return cache_dir() / h.hexdigest()
+
+def read_cache(path: Path) -> T.Optional[str]:
+    try:
+        formatted = path.read_text(encoding='utf-8')
+        # Mark the entry as recently used for prune_cache()
+        os.utime(path)
+    except (OSError, UnicodeDecodeError):
+        return None
+    return formatted
+
+def write_cache(path: Path, formatted: str) -> None:
+    # The cache is only an optimization, never fail because of it. Write to
+    # a temporary file first, so that readers never see a partial entry.
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(formatted, encoding='utf-8')
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return
+    prune_cache(path.parent)
+
+def prune_cache(directory: Path) -> None:
+    entries = []  # type: T.List[T.Tuple[float, str]]
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                # Skip the temporary files of other writers
+                if not entry.name.endswith('.tmp'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+    except OSError:
+        return
+    if len(entries) <= CACHE_MAX_ENTRIES:
+        return
+    entries.sort()
+    for _, entry_path in entries[:len(entries) - CACHE_MAX_ENTRIES]:
+        try:
+            os.unlink(entry_path)
+        except OSError:
+            # Another process may have removed it already
+            pass
+
+def format_uncached(file: str, code: str, config: T.Dict[str, T.Any]) -> str:
     try:
         parser = mparser.Parser(code, file)
         codeblock = parser.parse()
     except mesonlib.MesonException as me:
         me.file = file
         raise me
-    config = parse_fmt_config(options.config)
     formatter = AstFormatter2(code.splitlines(), config)
     codeblock.accept(formatter)
     formatter.end()
-    if not options.inplace:
-        real_output = sys.stdout if output is None else open(output, 'w', encoding='utf8')
+    return '\n'.join(formatter.lines) + '\n'
+
+def format_code(options: argparse.Namespace, file: str, output: str, code: str) -> int:
+    config = parse_fmt_config(options.config)
+    if options.cache:
+        path = cache_path(code, config)
+        cached = read_cache(path)
+        if cached is None:
+            formatted = format_uncached(file, code, config)
+            write_cache(path, formatted)
+        else:
+            formatted = cached
+    else:
+        formatted = format_uncached(file, code, config)
+    if options.inplace:
+        output = file
+        # Don't touch files that are already formatted
+        if formatted == code:
+            return 0
+    if output is None:
+        sys.stdout.write(formatted)
     else:
-        real_output = open(file, 'w', encoding='utf8')
-    for line in formatter.lines:
-        print(line, end='\n', file=real_output)
+        with open(output, 'w', encoding='utf8') as f:
+            f.write(formatted)
     return 0
 
+def format_source(options: argparse.Namespace, file: str, code: str) -> T.Optional[str]:
+    try:
+        format_code(options, file, file, code)
+    except mesonlib.MesonException as me:
+        return f'{me}\nUnable to format {file}'
+    return None
+
+def format_file(options: argparse.Namespace, file: str) -> T.Optional[str]:
+    with open(file, encoding='utf-8') as f:
+        code = f.read()
+    return format_source(options, file, code)
+
+def read_ahead(files: T.List[str]) -> T.Iterator[T.Tuple[str, str]]:
+    # Read the files in a background thread, so that waiting for the disk
+    # overlaps with parsing and formatting the previous file. The queue is
+    # bounded to avoid keeping a whole source tree in memory.
+    q = queue.Queue(maxsize=4)  # type: queue.Queue[T.Union[T.Tuple[str, str], BaseException, None]]
+
+    def reader() -> None:
+        try:
+            for file in files:
+                with open(file, encoding='utf-8') as f:
+                    q.put((file, f.read()))
+        except BaseException as e:
+            q.put(e)
+            return
+        q.put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def format_files(options: argparse.Namespace, files: T.List[str]) -> T.List[T.Optional[str]]:
+    # Every file is parsed and formatted independently, so spread them over
+    # all cores unless there is nothing to share. Frozen executables stay
+    # serial: their worker processes would run the entry point again
+    # unless it calls multiprocessing.freeze_support().
+    if len(files) > 1 and (os.cpu_count() or 1) > 1 and not getattr(sys, 'frozen', False):
+        with ProcessPoolExecutor() as e:
+            return list(e.map(format_file, itertools.repeat(options), files, chunksize=8))
+    return [format_source(options, f, code) for f, code in read_ahead(files)]
+
 def run(options: argparse.Namespace) -> int:
     if options.file == '-':
         code = sys.stdin.read()
@@ -79,16 +229,10 @@ def run(options: argparse.Namespace) -> int:
             else:
                 # Always do inplace editing
                 options.inplace = True
-                for path in Path(options.file).rglob('meson.build'):
-                    full_path = str(path)
-                    with open(full_path, encoding='utf-8') as f:
-                        code = f.read()
-                    try:
-                        format_code(options, full_path, full_path, code)
-                    except mesonlib.MesonException as me:
-                        print(me, file=sys.stderr)
-                        print("Unable to format", full_path, file=sys.stderr)
-
+                files = [str(path) for path in Path(options.file).rglob('meson.build')]
+                for error in format_files(options, files):
+                    if error is not None:
+                        print(error, file=sys.stderr)
                 return 0
         else:
             with open(options.file, encoding='utf-8') as f:
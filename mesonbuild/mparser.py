@@ -13,8 +13,12 @@
 # limitations under the License.
 
 from dataclasses import dataclass
+import array
+import bisect
+import heapq
 import re
 import codecs
+import sys
 import types
 import typing as T
 from .mesonlib import MesonException
@@ -89,6 +93,11 @@ TV_TokenTypes = T.TypeVar('TV_TokenTypes', int, str, bool)
 
 @dataclass(eq=False)
 class Token(T.Generic[TV_TokenTypes]):
+    # There is one of these for every token of every parsed file, so don't
+    # give them a __dict__. None of the fields has a default, which would
+    # clash with the slots.
+    __slots__ = ('tid', 'filename', 'line_start', 'lineno', 'colno', 'bytespan', 'value')
+
     tid: str
     filename: str
     line_start: int
@@ -97,15 +106,10 @@ class Token(T.Generic[TV_TokenTypes]):
     bytespan: T.Tuple[int, int]
     value: TV_TokenTypes
 
-    def __eq__(self, other: object) -> bool:
-        if isinstance(other, str):
-            return self.tid == other
-        elif isinstance(other, Token):
-            return self.tid == other.tid
-        return NotImplemented
-
 @dataclass(eq=False)
 class Comment:
+    __slots__ = ('line_start', 'lineno', 'colno', 'bytespan', 'text')
+
     line_start: int
     lineno: int
     colno: int
@@ -117,56 +121,140 @@ class Comment:
             return self.line_start == other.line_start and self.colno == other.colno
         return False
 
+_KEYWORDS = frozenset({'true', 'false', 'if', 'else', 'elif',
+                       'endif', 'and', 'or', 'not', 'foreach', 'endforeach',
+                       'in', 'continue', 'break'})
+_FUTURE_KEYWORDS = frozenset({'return'})
+# The token id of every keyword, which is the keyword itself
+_KEYWORD_TOKENS = {kw: kw for kw in _KEYWORDS}  # type: T.Dict[str, str]
+_BOOLEAN_KEYWORDS = frozenset({'true', 'false'})
+_STRING_TOKENS = frozenset({'string', 'fstring'})
+_MULTILINE_STRING_TOKENS = frozenset({'multiline_string', 'multiline_fstring'})
+_TOKEN_SPECIFICATION = [
+    # Need to be sorted longest to shortest.
+    ('ignore', re.compile(r'[ \t]')),
+    ('multiline_fstring', re.compile(r"f'''(.|\n)*?'''", re.M)),
+    ('fstring', re.compile(r"f'([^'\\]|(\\.))*'")),
+    ('id', re.compile('[_a-zA-Z][_0-9a-zA-Z]*')),
+    ('number', re.compile(r'0[bB][01]+|0[oO][0-7]+|0[xX][0-9a-fA-F]+|0|[1-9]\d*')),
+    ('eol_cont', re.compile(r'\\\n')),
+    ('eol', re.compile(r'\n')),
+    ('multiline_string', re.compile(r"'''(.|\n)*?'''", re.M)),
+    ('comment', re.compile(r'#.*')),
+    ('lparen', re.compile(r'\(')),
+    ('rparen', re.compile(r'\)')),
+    ('lbracket', re.compile(r'\[')),
+    ('rbracket', re.compile(r'\]')),
+    ('lcurl', re.compile(r'\{')),
+    ('rcurl', re.compile(r'\}')),
+    ('dblquote', re.compile(r'"')),
+    ('string', re.compile(r"'([^'\\]|(\\.))*'")),
+    ('comma', re.compile(r',')),
+    ('plusassign', re.compile(r'\+=')),
+    ('dot', re.compile(r'\.')),
+    ('plus', re.compile(r'\+')),
+    ('dash', re.compile(r'-')),
+    ('star', re.compile(r'\*')),
+    ('percent', re.compile(r'%')),
+    ('fslash', re.compile(r'/')),
+    ('colon', re.compile(r':')),
+    ('equal', re.compile(r'==')),
+    ('nequal', re.compile(r'!=')),
+    ('assign', re.compile(r'=')),
+    ('le', re.compile(r'<=')),
+    ('lt', re.compile(r'<')),
+    ('ge', re.compile(r'>=')),
+    ('gt', re.compile(r'>')),
+    ('questionmark', re.compile(r'\?')),
+]
+
+# Try all patterns with a single regex match, in the order above. The name of
+# the group that matched says which token it is.
+_TOKEN_RE = re.compile('|'.join(f'(?P<{tid}>{reg.pattern})' for tid, reg in _TOKEN_SPECIFICATION), re.M)
+# The token id for the index of each group of _TOKEN_RE. The ids are interned
+# like the literals the parser compares them with, so that those comparisons
+# are pointer comparisons. The names re hands out are fresh strings.
+_TOKEN_IDS = [''] * (_TOKEN_RE.groups + 1)
+for _tid, _idx in _TOKEN_RE.groupindex.items():
+    _TOKEN_IDS[_idx] = sys.intern(_tid)
+
+# Tokens which always consist of just this one character
+_SINGLE_CHAR_TOKENS = {
+    '\n': 'eol',
+    '(': 'lparen',
+    ')': 'rparen',
+    '[': 'lbracket',
+    ']': 'rbracket',
+    '{': 'lcurl',
+    '}': 'rcurl',
+    '"': 'dblquote',
+    ',': 'comma',
+    '.': 'dot',
+    '-': 'dash',
+    '*': 'star',
+    '%': 'percent',
+    '/': 'fslash',
+    ':': 'colon',
+    '?': 'questionmark',
+}
+_ID_START = frozenset('_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+# The characters a single quoted string or f-string starts with
+_QUOTE_START = frozenset("'f")
+_ID_RE = re.compile('[_a-zA-Z][_0-9a-zA-Z]*')
+
+def _token_regex(tids: T.Sequence[str]) -> T.Tuple[T.Pattern[str], T.List[str]]:
+    # Like _TOKEN_RE and _TOKEN_IDS, for just the given tokens
+    patterns = dict(_TOKEN_SPECIFICATION)
+    regex = re.compile('|'.join(f'(?P<{tid}>{patterns[tid].pattern})' for tid in tids), re.M)
+    ids = [''] * (regex.groups + 1)
+    for tid, idx in regex.groupindex.items():
+        ids[idx] = sys.intern(tid)
+    return regex, ids
+
+# The only tokens that can start with a given character, in the order of
+# _TOKEN_SPECIFICATION, for the characters not handled without a regex. An f
+# is only looked up here when it is followed by a quote, but it still falls
+# back to an id if the f-string isn't terminated.
+_FIRST_CHAR_TOKENS = {
+    "'": ('multiline_string', 'string'),
+    'f': ('multiline_fstring', 'fstring', 'id'),
+    '#': ('comment',),
+    '\\': ('eol_cont',),
+    '+': ('plusassign', 'plus'),
+    '=': ('equal', 'assign'),
+    '!': ('nequal',),
+    '<': ('le', 'lt'),
+    '>': ('ge', 'gt'),
+}  # type: T.Dict[str, T.Tuple[str, ...]]
+_FIRST_CHAR_TOKENS.update((str(i), ('number',)) for i in range(10))
+_FIRST_CHAR_REGEX = {c: _token_regex(tids) for c, tids in _FIRST_CHAR_TOKENS.items()}
+
 class Lexer:
     def __init__(self, code: str):
         self.code = code
-        self.keywords = {'true', 'false', 'if', 'else', 'elif',
-                         'endif', 'and', 'or', 'not', 'foreach', 'endforeach',
-                         'in', 'continue', 'break'}
-        self.future_keywords = {'return'}
+        self.keywords = _KEYWORDS
+        self.future_keywords = _FUTURE_KEYWORDS
         self.comments = [] # type: T.List[Comment]
-        self.token_specification = [
-            # Need to be sorted longest to shortest.
-            ('ignore', re.compile(r'[ \t]')),
-            ('multiline_fstring', re.compile(r"f'''(.|\n)*?'''", re.M)),
-            ('fstring', re.compile(r"f'([^'\\]|(\\.))*'")),
-            ('id', re.compile('[_a-zA-Z][_0-9a-zA-Z]*')),
-            ('number', re.compile(r'0[bB][01]+|0[oO][0-7]+|0[xX][0-9a-fA-F]+|0|[1-9]\d*')),
-            ('eol_cont', re.compile(r'\\\n')),
-            ('eol', re.compile(r'\n')),
-            ('multiline_string', re.compile(r"'''(.|\n)*?'''", re.M)),
-            ('comment', re.compile(r'#.*')),
-            ('lparen', re.compile(r'\(')),
-            ('rparen', re.compile(r'\)')),
-            ('lbracket', re.compile(r'\[')),
-            ('rbracket', re.compile(r'\]')),
-            ('lcurl', re.compile(r'\{')),
-            ('rcurl', re.compile(r'\}')),
-            ('dblquote', re.compile(r'"')),
-            ('string', re.compile(r"'([^'\\]|(\\.))*'")),
-            ('comma', re.compile(r',')),
-            ('plusassign', re.compile(r'\+=')),
-            ('dot', re.compile(r'\.')),
-            ('plus', re.compile(r'\+')),
-            ('dash', re.compile(r'-')),
-            ('star', re.compile(r'\*')),
-            ('percent', re.compile(r'%')),
-            ('fslash', re.compile(r'/')),
-            ('colon', re.compile(r':')),
-            ('equal', re.compile(r'==')),
-            ('nequal', re.compile(r'!=')),
-            ('assign', re.compile(r'=')),
-            ('le', re.compile(r'<=')),
-            ('lt', re.compile(r'<')),
-            ('ge', re.compile(r'>=')),
-            ('gt', re.compile(r'>')),
-            ('questionmark', re.compile(r'\?')),
-        ]
+        self.token_specification = _TOKEN_SPECIFICATION
+        self.master_re = _TOKEN_RE
+        self.line_ends = None  # type: T.Optional[array.array[int]]
 
     def getline(self, line_start: int) -> str:
-        return self.code[line_start:self.code.find('\n', line_start)]
+        # Only needed for diagnostics, so index the line ends on first use.
+        # A packed array keeps the offsets out of individual int objects.
+        if self.line_ends is None:
+            self.line_ends = line_ends = array.array('q')
+            pos = self.code.find('\n')
+            while pos != -1:
+                line_ends.append(pos)
+                pos = self.code.find('\n', pos + 1)
+        idx = bisect.bisect_left(self.line_ends, line_start)
+        line_end = self.line_ends[idx] if idx < len(self.line_ends) else -1
+        return self.code[line_start:line_end]
 
     def lex(self, filename: str) -> T.Generator[Token, None, None]:
+        # Every token and node refers to it
+        filename = sys.intern(filename)
         line_start = 0
         lineno = 1
         loc = 0
@@ -174,193 +262,285 @@ class Lexer:
         bracket_count = 0
         curl_count = 0
         col = 0
-        while loc < len(self.code):
-            matched = False
-            value = None  # type: T.Union[str, bool, int]
-            for (tid, reg) in self.token_specification:
-                mo = reg.match(self.code, loc)
-                if mo:
-                    curline = lineno
-                    curline_start = line_start
-                    col = mo.start() - line_start
-                    matched = True
-                    span_start = loc
+        code = self.code
+        code_len = len(code)
+        master_re = self.master_re
+        future_keywords = self.future_keywords
+        comments = self.comments
+        getline = self.getline
+        while loc < code_len:
+            c = code[loc]
+            span_start = loc
+            # Handle the most common tokens by looking at the first character,
+            # and only use the regex for everything else.
+            if c in ' \t':
+                loc += 1
+                while loc < code_len and code[loc] in ' \t':
+                    loc += 1
+                col = loc - 1 - line_start
+                continue
+            tid = _SINGLE_CHAR_TOKENS.get(c)
+            if tid is not None:
+                loc += 1
+                match_text = c
+            elif c in _ID_START and not (c == 'f' and code.startswith("'", loc + 1)):
+                loc = _ID_RE.match(code, loc).end()
+                tid = 'id'
+                match_text = code[span_start:loc]
+            elif c == '#':
+                loc = code.find('\n', loc)
+                if loc == -1:
+                    loc = code_len
+                tid = 'comment'
+                match_text = code[span_start:loc]
+            else:
+                # A string without escape sequences ends at the next quote,
+                # everything else is left to the regex.
+                end = -1
+                if c in _QUOTE_START:
+                    quote = loc if c == "'" else loc + 1
+                    if not code.startswith("''", quote + 1):
+                        end = code.find("'", quote + 1)
+                        if end != -1 and code.find('\\', quote + 1, end) != -1:
+                            end = -1
+                if end != -1:
+                    loc = end + 1
+                    tid = 'string' if c == "'" else 'fstring'
+                    match_text = code[span_start:loc]
+                else:
+                    # Anything else can't be a valid token, but use all
+                    # patterns anyway to be sure.
+                    regex, ids = _FIRST_CHAR_REGEX.get(c, (master_re, _TOKEN_IDS))
+                    mo = regex.match(code, loc)
+                    if not mo:
+                        raise ParseException('lexer', getline(line_start), lineno, col)
+                    tid = ids[mo.lastindex]
                     loc = mo.end()
-                    span_end = loc
-                    bytespan = (span_start, span_end)
                     match_text = mo.group()
-                    if tid == 'ignore':
-                        break
-                    elif tid == 'lparen':
-                        par_count += 1
-                    elif tid == 'rparen':
-                        par_count -= 1
-                    elif tid == 'lbracket':
-                        bracket_count += 1
-                    elif tid == 'rbracket':
-                        bracket_count -= 1
-                    elif tid == 'lcurl':
-                        curl_count += 1
-                    elif tid == 'rcurl':
-                        curl_count -= 1
-                    elif tid == 'dblquote':
-                        raise ParseException('Double quotes are not supported. Use single quotes.', self.getline(line_start), lineno, col)
-                    elif tid in {'string', 'fstring'}:
-                        # Handle here and not on the regexp to give a better error message.
-                        if match_text.find("\n") != -1:
-                            msg = ParseException("Newline character in a string detected, use ''' (three single quotes) "
-                                                 "for multiline strings instead.\n"
-                                                 "This will become a hard error in a future Meson release.",
-                                                 self.getline(line_start), lineno, col)
-                            mlog.warning(msg, location=BaseNode(lineno, col, filename))
-                        value = match_text[2 if tid == 'fstring' else 1:-1]
-                        try:
-                            value = ESCAPE_SEQUENCE_SINGLE_RE.sub(decode_match, value)
-                        except MesonUnicodeDecodeError as err:
-                            raise MesonException(f"Failed to parse escape sequence: '{err.match}' in string:\n  {match_text}")
-                    elif tid in {'multiline_string', 'multiline_fstring'}:
-                        # For multiline strings, parse out the value and pass
-                        # through the normal string logic.
-                        # For multiline format strings, we have to emit a
-                        # different AST node so we can add a feature check,
-                        # but otherwise, it follows the normal fstring logic.
-                        if tid == 'multiline_string':
-                            value = match_text[3:-3]
-                            tid = 'string'
-                        else:
-                            value = match_text[4:-3]
-                        lines = match_text.split('\n')
-                        if len(lines) > 1:
-                            lineno += len(lines) - 1
-                            line_start = mo.end() - len(lines[-1])
-                    elif tid == 'number':
-                        value = int(match_text, base=0)
-                    elif tid == 'eol_cont':
-                        lineno += 1
-                        line_start = loc
-                        break
-                    elif tid == 'eol':
-                        lineno += 1
-                        line_start = loc
-                        if par_count > 0 or bracket_count > 0 or curl_count > 0:
-                            break
-                    elif tid == 'comment':
-                        self.comments.append(Comment(curline_start, curline, col, bytespan, match_text))
-                        break
-                    elif tid == 'id':
-                        if match_text in self.keywords:
-                            tid = match_text
-                        else:
-                            if match_text in self.future_keywords:
-                                mlog.warning(f"Identifier '{match_text}' will become a reserved keyword in a future release. Please rename it.",
-                                             location=types.SimpleNamespace(filename=filename, lineno=lineno))
-                            value = match_text
-                    yield Token(tid, filename, curline_start, curline, col, bytespan, value)
-                    break
-            if not matched:
-                raise ParseException('lexer', self.getline(line_start), lineno, col)
+            curline = lineno
+            curline_start = line_start
+            col = span_start - line_start
+            bytespan = (span_start, loc)
+            # Every kind of token is yielded from its own branch, so that each
+            # yield always gets a value of the same type.
+            if tid == 'id':
+                keyword = _KEYWORD_TOKENS.get(match_text)
+                if keyword is None:
+                    if match_text in future_keywords:
+                        mlog.warning(f"Identifier '{match_text}' will become a reserved keyword in a future release. Please rename it.",
+                                     location=types.SimpleNamespace(filename=filename, lineno=lineno))
+                    # The same few names are used over and over, so share them
+                    yield Token('id', filename, curline_start, curline, col, bytespan, sys.intern(match_text))
+                elif keyword in _BOOLEAN_KEYWORDS:
+                    yield Token(keyword, filename, curline_start, curline, col, bytespan, keyword == 'true')
+                else:
+                    yield Token(keyword, filename, curline_start, curline, col, bytespan, None)
+                continue
+            elif tid == 'eol':
+                lineno += 1
+                line_start = loc
+                if par_count > 0 or bracket_count > 0 or curl_count > 0:
+                    continue
+            elif tid == 'lparen':
+                par_count += 1
+            elif tid == 'rparen':
+                par_count -= 1
+            elif tid == 'lbracket':
+                bracket_count += 1
+            elif tid == 'rbracket':
+                bracket_count -= 1
+            elif tid == 'lcurl':
+                curl_count += 1
+            elif tid == 'rcurl':
+                curl_count -= 1
+            elif tid in _STRING_TOKENS:
+                # Handle here and not on the regexp to give a better error message.
+                if match_text.find("\n") != -1:
+                    msg = ParseException("Newline character in a string detected, use ''' (three single quotes) "
+                                         "for multiline strings instead.\n"
+                                         "This will become a hard error in a future Meson release.",
+                                         getline(line_start), lineno, col)
+                    mlog.warning(msg, location=BaseNode(lineno, col, filename))
+                string = match_text[2 if tid == 'fstring' else 1:-1]
+                # Most strings don't contain any escape sequences at all
+                if '\\' in string:
+                    try:
+                        string = ESCAPE_SEQUENCE_SINGLE_RE.sub(decode_match, string)
+                    except MesonUnicodeDecodeError as err:
+                        raise MesonException(f"Failed to parse escape sequence: '{err.match}' in string:\n  {match_text}")
+                yield Token(tid, filename, curline_start, curline, col, bytespan, string)
+                continue
+            elif tid == 'number':
+                yield Token(tid, filename, curline_start, curline, col, bytespan, int(match_text, base=0))
+                continue
+            elif tid == 'comment':
+                comments.append(Comment(curline_start, curline, col, bytespan, match_text))
+                continue
+            elif tid == 'eol_cont':
+                lineno += 1
+                line_start = loc
+                continue
+            elif tid in _MULTILINE_STRING_TOKENS:
+                # For multiline strings, parse out the value and pass
+                # through the normal string logic.
+                # For multiline format strings, we have to emit a
+                # different AST node so we can add a feature check,
+                # but otherwise, it follows the normal fstring logic.
+                lines = match_text.split('\n')
+                if len(lines) > 1:
+                    lineno += len(lines) - 1
+                    line_start = loc - len(lines[-1])
+                if tid == 'multiline_string':
+                    yield Token('string', filename, curline_start, curline, col, bytespan, match_text[3:-3])
+                else:
+                    yield Token(tid, filename, curline_start, curline, col, bytespan, match_text[4:-3])
+                continue
+            elif tid == 'dblquote':
+                raise ParseException('Double quotes are not supported. Use single quotes.', getline(line_start), lineno, col)
+            # Everything else is an operator or punctuation without a value
+            yield Token(tid, filename, curline_start, curline, col, bytespan, None)
 
-@dataclass(eq=False)
 class BaseNode:
-    lineno: int
-    colno: int
-    filename: str
-    end_lineno: T.Optional[int] = None
-    end_colno: T.Optional[int] = None
-    bytespan: T.Optional[T.Tuple[int, int]] = None
-    pre_comments: T.Optional[T.List['Comment']] = None
-    comments: T.Optional[T.List['Comment']] = None
-    post_comments: T.Optional[T.List['Comment']] = None
-
-    def __post_init__(self) -> None:
-        if self.end_lineno is None:
-            self.end_lineno = self.lineno
-        if self.end_colno is None:
-            self.end_colno = self.colno
+    # Nodes are created in large numbers, so all of them use slots. This is
+    # not a dataclass because on older Pythons fields with defaults can't be
+    # combined with __slots__. Subclasses must declare their own attributes.
+    __slots__ = ('lineno', 'colno', 'filename', 'end_lineno', 'end_colno', 'bytespan',
+                 'pre_comments', 'comments', 'post_comments', 'level', 'ast_id', 'condition_level')
+
+    # The name of the visitor method for this class
+    visit_name = 'visit_BaseNode'  # type: T.ClassVar[str]
+
+    def __init_subclass__(cls) -> None:
+        super().__init_subclass__()
+        cls.visit_name = sys.intern('visit_' + cls.__name__)
+
+    def __init__(self, lineno: int, colno: int, filename: str, end_lineno: T.Optional[int] = None,
+                 end_colno: T.Optional[int] = None, bytespan: T.Optional[T.Tuple[int, int]] = None) -> None:
+        self.lineno = lineno  # type: int
+        self.colno = colno  # type: int
+        self.filename = filename  # type: str
+        self.end_lineno = lineno if end_lineno is None else end_lineno  # type: int
+        self.end_colno = colno if end_colno is None else end_colno  # type: int
+        self.bytespan = bytespan  # type: T.Optional[T.Tuple[int, int]]
+        # Most nodes have no comments, so the lists are only created when
+        # attach_comments() has something to put in them.
+        self.pre_comments = None  # type: T.Optional[T.List[Comment]]
+        self.comments = None  # type: T.Optional[T.List[Comment]]
+        self.post_comments = None  # type: T.Optional[T.List[Comment]]
 
         # Attributes for the visitors
         self.level = 0            # type: int
         self.ast_id = ''          # type: str
         self.condition_level = 0  # type: int
-        self.pre_comments = []
-        self.comments = []
-        self.post_comments = []
 
     def accept(self, visitor: 'AstVisitor') -> None:
-        fname = 'visit_{}'.format(type(self).__name__)
-        if hasattr(visitor, fname):
-            func = getattr(visitor, fname)
-            if callable(func):
-                func(self)
+        key = (type(visitor), type(self))
+        try:
+            func = _VISIT_CACHE[key]
+        except KeyError:
+            func = getattr(type(visitor), self.visit_name, None)
+            if not callable(func):
+                func = None
+            _VISIT_CACHE[key] = func
+        if func is not None:
+            func(visitor, self)
+
+# The visitor method for each pair of visitor and node class, or None if the
+# visitor doesn't handle that node, so that accept() doesn't need to look the
+# method up every time.
+_VISIT_CACHE = {}  # type: T.Dict[T.Tuple[type, type], T.Optional[T.Callable[[AstVisitor, BaseNode], None]]]
 
 class ElementaryNode(T.Generic[TV_TokenTypes], BaseNode):
+    __slots__ = ('value',)
+
+    # Subclasses check the type of the value in an __init__ that only exists
+    # when assertions are enabled, so -O doesn't pay for the extra call.
     def __init__(self, token: Token[TV_TokenTypes]):
-        super().__init__(token.lineno, token.colno, token.filename)
+        super().__init__(token.lineno, token.colno, token.filename, bytespan=token.bytespan)
         self.value = token.value        # type: TV_TokenTypes
-        self.bytespan = token.bytespan  # type: T.Tuple[int, int]
 
 class BooleanNode(ElementaryNode[bool]):
-    def __init__(self, token: Token[bool]):
-        super().__init__(token)
-        assert isinstance(self.value, bool)
+    __slots__ = ()
+
+    if __debug__:
+        def __init__(self, token: Token[bool]):
+            super().__init__(token)
+            assert isinstance(self.value, bool)
 
 class IdNode(ElementaryNode[str]):
-    def __init__(self, token: Token[str]):
-        super().__init__(token)
-        assert isinstance(self.value, str)
+    __slots__ = ()
+
+    if __debug__:
+        def __init__(self, token: Token[str]):
+            super().__init__(token)
+            assert isinstance(self.value, str)
 
     def __str__(self) -> str:
         return "Id node: '%s' (%d, %d)." % (self.value, self.lineno, self.colno)
 
 class NumberNode(ElementaryNode[int]):
-    def __init__(self, token: Token[int]):
-        super().__init__(token)
-        assert isinstance(self.value, int)
+    __slots__ = ()
+
+    if __debug__:
+        def __init__(self, token: Token[int]):
+            super().__init__(token)
+            assert isinstance(self.value, int)
 
 class StringNode(ElementaryNode[str]):
-    def __init__(self, token: Token[str]):
-        super().__init__(token)
-        assert isinstance(self.value, str)
+    __slots__ = ()
+
+    if __debug__:
+        def __init__(self, token: Token[str]):
+            super().__init__(token)
+            assert isinstance(self.value, str)
 
     def __str__(self) -> str:
         return "String node: '%s' (%d, %d)." % (self.value, self.lineno, self.colno)
 
 class FormatStringNode(ElementaryNode[str]):
-    def __init__(self, token: Token[str]):
-        super().__init__(token)
-        assert isinstance(self.value, str)
+    __slots__ = ()
+
+    if __debug__:
+        def __init__(self, token: Token[str]):
+            super().__init__(token)
+            assert isinstance(self.value, str)
 
     def __str__(self) -> str:
         return f"Format string node: '{self.value}' ({self.lineno}, {self.colno})."
 
 class MultilineFormatStringNode(FormatStringNode):
+    __slots__ = ()
+
     def __str__(self) -> str:
         return f"Multiline Format string node: '{self.value}' ({self.lineno}, {self.colno})."
 
 class ContinueNode(ElementaryNode):
-    pass
+    __slots__ = ()
 
 class BreakNode(ElementaryNode):
-    pass
+    __slots__ = ()
 
 class ArgumentNode(BaseNode):
+    __slots__ = ('arguments', 'commas', 'kwargs', 'order_error')
+
     def __init__(self, token: Token[TV_TokenTypes]):
         super().__init__(token.lineno, token.colno, token.filename)
         self.arguments = []  # type: T.List[BaseNode]
-        self.commas = []     # type: T.List[Token[TV_TokenTypes]]
+        # Only the offsets of the commas, instead of keeping their tokens alive
+        self.commas = array.array('q')  # type: array.array[int]
         self.kwargs = {}     # type: T.Dict[BaseNode, BaseNode]
         self.order_error = False
 
     def prepend(self, statement: BaseNode) -> None:
         if self.num_kwargs() > 0:
             self.order_error = True
-        if not isinstance(statement, EmptyNode):
+        if type(statement) is not EmptyNode:
             self.arguments = [statement] + self.arguments
 
     def append(self, statement: BaseNode) -> None:
         if self.num_kwargs() > 0:
             self.order_error = True
-        if not isinstance(statement, EmptyNode):
+        if type(statement) is not EmptyNode:
             self.arguments += [statement]
 
     def set_kwarg(self, name: IdNode, value: BaseNode) -> None:
@@ -385,33 +565,47 @@ class ArgumentNode(BaseNode):
         return self.num_args() # Fixme
 
 class ArrayNode(BaseNode):
+    __slots__ = ('args',)
+
     def __init__(self, args: ArgumentNode, lineno: int, colno: int, end_lineno: int, end_colno: int):
         super().__init__(lineno, colno, args.filename, end_lineno=end_lineno, end_colno=end_colno)
         self.args = args              # type: ArgumentNode
 
 class DictNode(BaseNode):
+    __slots__ = ('args',)
+
     def __init__(self, args: ArgumentNode, lineno: int, colno: int, end_lineno: int, end_colno: int):
         super().__init__(lineno, colno, args.filename, end_lineno=end_lineno, end_colno=end_colno)
         self.args = args
 
 class EmptyNode(BaseNode):
+    # The parser tests for these with an exact type check, which is cheaper
+    # than isinstance(), so this must not be subclassed.
+    __slots__ = ('value',)
+
     def __init__(self, lineno: int, colno: int, filename: str):
         super().__init__(lineno, colno, filename)
         self.value = None
 
 class OrNode(BaseNode):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left: BaseNode, right: BaseNode):
         super().__init__(left.lineno, left.colno, left.filename)
         self.left = left    # type: BaseNode
         self.right = right  # type: BaseNode
 
 class AndNode(BaseNode):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left: BaseNode, right: BaseNode):
         super().__init__(left.lineno, left.colno, left.filename)
         self.left = left    # type: BaseNode
         self.right = right  # type: BaseNode
 
 class ComparisonNode(BaseNode):
+    __slots__ = ('left', 'right', 'ctype')
+
     def __init__(self, ctype: str, left: BaseNode, right: BaseNode):
         super().__init__(left.lineno, left.colno, left.filename)
         self.left = left    # type: BaseNode
@@ -419,6 +613,8 @@ class ComparisonNode(BaseNode):
         self.ctype = ctype  # type: str
 
 class ArithmeticNode(BaseNode):
+    __slots__ = ('left', 'right', 'operation')
+
     def __init__(self, operation: str, left: BaseNode, right: BaseNode):
         super().__init__(left.lineno, left.colno, left.filename)
         self.left = left            # type: BaseNode
@@ -426,22 +622,30 @@ class ArithmeticNode(BaseNode):
         self.operation = operation  # type: str
 
 class NotNode(BaseNode):
+    __slots__ = ('value',)
+
     def __init__(self, token: Token[TV_TokenTypes], value: BaseNode):
         super().__init__(token.lineno, token.colno, token.filename)
         self.value = value  # type: BaseNode
 
 class CodeBlockNode(BaseNode):
+    __slots__ = ('lines',)
+
     def __init__(self, token: Token[TV_TokenTypes]):
         super().__init__(token.lineno, token.colno, token.filename)
         self.lines = []  # type: T.List[BaseNode]
 
 class IndexNode(BaseNode):
+    __slots__ = ('iobject', 'index')
+
     def __init__(self, iobject: BaseNode, index: BaseNode):
         super().__init__(iobject.lineno, iobject.colno, iobject.filename)
         self.iobject = iobject  # type: BaseNode
         self.index = index      # type: BaseNode
 
 class MethodNode(BaseNode):
+    __slots__ = ('source_object', 'name', 'args')
+
     def __init__(self, filename: str, lineno: int, colno: int, source_object: BaseNode, name: str, args: ArgumentNode):
         super().__init__(lineno, colno, filename)
         self.source_object = source_object  # type: BaseNode
@@ -450,6 +654,8 @@ class MethodNode(BaseNode):
         self.args = args                    # type: ArgumentNode
 
 class FunctionNode(BaseNode):
+    __slots__ = ('func_name', 'args')
+
     def __init__(self, filename: str, lineno: int, colno: int, end_lineno: int, end_colno: int, func_name: str, args: ArgumentNode):
         super().__init__(lineno, colno, filename, end_lineno=end_lineno, end_colno=end_colno)
         self.func_name = func_name  # type: str
@@ -457,6 +663,8 @@ class FunctionNode(BaseNode):
         self.args = args  # type: ArgumentNode
 
 class AssignmentNode(BaseNode):
+    __slots__ = ('var_name', 'value')
+
     def __init__(self, filename: str, lineno: int, colno: int, var_name: str, value: BaseNode):
         super().__init__(lineno, colno, filename)
         self.var_name = var_name  # type: str
@@ -464,6 +672,8 @@ class AssignmentNode(BaseNode):
         self.value = value  # type: BaseNode
 
 class PlusAssignmentNode(BaseNode):
+    __slots__ = ('var_name', 'value')
+
     def __init__(self, filename: str, lineno: int, colno: int, var_name: str, value: BaseNode):
         super().__init__(lineno, colno, filename)
         self.var_name = var_name  # type: str
@@ -471,6 +681,8 @@ class PlusAssignmentNode(BaseNode):
         self.value = value  # type: BaseNode
 
 class ForeachClauseNode(BaseNode):
+    __slots__ = ('varnames', 'items', 'block')
+
     def __init__(self, token: Token, varnames: T.List[str], items: BaseNode, block: CodeBlockNode):
         super().__init__(token.lineno, token.colno, token.filename)
         self.varnames = varnames  # type: T.List[str]
@@ -478,28 +690,38 @@ class ForeachClauseNode(BaseNode):
         self.block = block        # type: CodeBlockNode
 
 class IfNode(BaseNode):
+    __slots__ = ('condition', 'block')
+
     def __init__(self, linenode: BaseNode, condition: BaseNode, block: CodeBlockNode):
         super().__init__(linenode.lineno, linenode.colno, linenode.filename)
         self.condition = condition  # type: BaseNode
         self.block = block          # type: CodeBlockNode
 
 class IfClauseNode(BaseNode):
+    __slots__ = ('ifs', 'elseblock')
+
     def __init__(self, linenode: BaseNode):
         super().__init__(linenode.lineno, linenode.colno, linenode.filename)
         self.ifs = []          # type: T.List[IfNode]
         self.elseblock = None  # type: T.Union[EmptyNode, CodeBlockNode]
 
 class ParenthesizedNode(BaseNode):
+    __slots__ = ('inner',)
+
     def __init__(self, inner: BaseNode, lineno: int, colno: int, end_lineno: int, end_colno: int):
         super().__init__(lineno, colno, inner.filename, end_lineno=end_lineno, end_colno=end_colno)
         self.inner = inner              # type: BaseNode
 
 class UMinusNode(BaseNode):
+    __slots__ = ('value',)
+
     def __init__(self, current_location: Token, value: BaseNode):
         super().__init__(current_location.lineno, current_location.colno, current_location.filename)
         self.value = value  # type: BaseNode
 
 class TernaryNode(BaseNode):
+    __slots__ = ('condition', 'trueblock', 'falseblock')
+
     def __init__(self, condition: BaseNode, trueblock: BaseNode, falseblock: BaseNode):
         super().__init__(condition.lineno, condition.colno, condition.filename)
         self.condition = condition    # type: BaseNode
@@ -516,6 +738,40 @@ comparison_map = {'equal': '==',
                   'notin': 'not in',
                   }
 
+# The precedence levels of the binary operators, lowest first. A 'not' at the
+# comparison level starts 'not in'.
+_OR_LEVEL, _AND_LEVEL, _COMPARISON_LEVEL, _ADDSUB_LEVEL, _MULDIV_LEVEL = range(5)
+# The levels whose operands must not be empty
+_LOGICAL_LEVELS = frozenset({_OR_LEVEL, _AND_LEVEL})
+_BINARY_LEVELS = {
+    'or': _OR_LEVEL,
+    'and': _AND_LEVEL,
+    'not': _COMPARISON_LEVEL,
+    'plus': _ADDSUB_LEVEL,
+    'dash': _ADDSUB_LEVEL,
+    'percent': _MULDIV_LEVEL,
+    'star': _MULDIV_LEVEL,
+    'fslash': _MULDIV_LEVEL,
+}
+_BINARY_LEVELS.update((tid, _COMPARISON_LEVEL) for tid in comparison_map)
+_ARITHMETIC_OPS = {
+    'plus': 'add',
+    'dash': 'sub',
+    'percent': 'mod',
+    'star': 'mul',
+    'fslash': 'div',
+}
+# The node for each token that is a complete operand on its own
+_LEAF_NODES = {
+    'true': BooleanNode,
+    'false': BooleanNode,
+    'id': IdNode,
+    'number': NumberNode,
+    'string': StringNode,
+    'fstring': FormatStringNode,
+    'multiline_fstring': MultilineFormatStringNode,
+}  # type: T.Dict[str, T.Type[ElementaryNode]]
+
 # Recursive descent parser for Meson's definition language.
 # Very basic apart from the fact that we have many precedence
 # levels so there are not enough words to describe them all.
@@ -538,18 +794,17 @@ class Parser:
         self.current = Token('eof', '', 0, 0, 0, (0, 0), None)  # type: Token
         self.getsym()
         self.in_ternary = False
-        self.stack = [] # type: T.List[Token]
-        self.nodes = set() # type: T.Set[BaseNode]
-
-    def begin(self) -> None:
-        self.stack.append(self.current)
+        self.nodes = [] # type: T.List[BaseNode]
 
-    def end(self, node: BaseNode) -> None:
-        assert len(self.stack) > 0
-        token = self.stack.pop()
-        # print("%s: [%s:%s] -> [%s:%s] (%s %s)"%(type(node), token.lineno, token.colno, self.current.lineno, self.current.colno, token.bytespan, self.current.bytespan))
+    def set_span(self, node: BaseNode, token: Token) -> None:
+        # Set the span of a node from its first token to the current one. Rules
+        # often do this again for a node they got from another rule, so skip
+        # those repeats. Other duplicates are rare and don't change where
+        # comments get attached.
         node.bytespan = (token.bytespan[0], self.current.bytespan[0])
-        self.nodes.add(node)
+        nodes = self.nodes
+        if not nodes or nodes[-1] is not node:
+            nodes.append(node)
 
     def comments(self) -> T.List[Comment]:
         return self.lexer.comments
@@ -558,24 +813,25 @@ class Parser:
         try:
             self.current = next(self.stream)
         except StopIteration:
-            self.current = Token('eof', '', self.current.line_start, self.current.lineno, self.current.colno + self.current.bytespan[1] - self.current.bytespan[0], (0, 0), None)
+            self.set_eof()
+
+    def set_eof(self) -> None:
+        self.current = Token('eof', '', self.current.line_start, self.current.lineno, self.current.colno + self.current.bytespan[1] - self.current.bytespan[0], (0, 0), None)
 
     def getline(self) -> str:
         return self.lexer.getline(self.current.line_start)
 
     def accept(self, s: str) -> bool:
+        # This is called for every alternative of every rule, so getsym() is
+        # inlined here.
         if self.current.tid == s:
-            self.getsym()
+            try:
+                self.current = next(self.stream)
+            except StopIteration:
+                self.set_eof()
             return True
         return False
 
-    def accept_any(self, tids: T.Tuple[str, ...]) -> str:
-        tid = self.current.tid
-        if tid in tids:
-            self.getsym()
-            return tid
-        return ''
-
     def expect(self, s: str) -> bool:
         if self.accept(s):
             return True
@@ -589,70 +845,69 @@ class Parser:
     def parse(self) -> CodeBlockNode:
         block = self.codeblock()
         self.expect('eof')
-        for s in self.stack:
-            print(s)
-        assert len(self.stack) == 0
-        for c in self.lexer.comments:
-            self.attach_comment(c)
+        self.attach_comments(self.lexer.comments)
         return block
 
     def attach_comment(self, comment: Comment) -> None:
-        if len(self.nodes) == 0:
-            return
-        smallest_distance = 100000000000
-        node = None
-        for n in self.nodes:
-            # Comment is before node
-            if n.bytespan[0] > comment.bytespan[0]:
-                continue
-            # Comment is after node
-            if n.bytespan[1] < comment.bytespan[0]:
-                continue
-            distance = n.bytespan[1] - n.bytespan[0]
-            if smallest_distance > distance:
-                smallest_distance = distance
-                node = n
-        if node is not None:
-            node.comments.append(comment)
-            return
-        smallest_distance = 100000000000
-        node = None
-        # Now we try to attach the comment to nodes that are before it
-        for n in self.nodes:
-            # Comment is before node
-            if n.bytespan[0] > comment.bytespan[0]:
-                continue
-            distance = n.bytespan[1] - comment.bytespan[0]
-            if smallest_distance > distance:
-                smallest_distance = distance
-                node = n
-        if node is not None:
-            node.pre_comments.append(comment)
+        self.attach_comments([comment])
+
+    def attach_comments(self, comments: T.List[Comment]) -> None:
+        # Each comment is attached to the smallest node enclosing it, or else
+        # to the node before it that ends first, or else to the node after it
+        # that starts last. Ties go to the node that was parsed first.
+        nodes = self.nodes
+        if len(nodes) == 0:
             return
-        smallest_distance = 100000000000
-        node = None
-        # Now we try to attach the comment to nodes that are after it
-        for n in self.nodes:
-            # Comment is after node
-            if comment.bytespan[1] < n.bytespan[0]:
-                continue
-            distance = comment.bytespan[1] - n.bytespan[0]
-            if smallest_distance > distance:
-                smallest_distance = distance
-                node = n
-        if node is not None:
-            node.post_comments.append(comment)
-            return
-        assert node is not None
+        # Sweep over the nodes by start; sorting is stable, so nodes with the
+        # same start stay in parse order.
+        order = sorted(range(len(nodes)), key=lambda i: nodes[i].bytespan[0])
+        starts = [nodes[i].bytespan[0] for i in order]
+        # (length, index, end) of the nodes starting before the comment
+        enclosing = []  # type: T.List[T.Tuple[int, int, int]]
+        # (end, index) of the node starting before the comment that ends first
+        first_end = None  # type: T.Optional[T.Tuple[int, int]]
+        pos = 0
+        for comment in sorted(comments, key=lambda c: c.bytespan[0]):
+            comment_start, comment_end = comment.bytespan
+            while pos < len(order) and starts[pos] <= comment_start:
+                idx = order[pos]
+                start, end = nodes[idx].bytespan
+                heapq.heappush(enclosing, (end - start, idx, end))
+                if first_end is None or (end, idx) < first_end:
+                    first_end = (end, idx)
+                pos += 1
+            # Comments come in order, so nodes ending before this one can't
+            # enclose any of the following comments either.
+            while enclosing and enclosing[0][2] < comment_start:
+                heapq.heappop(enclosing)
+            if enclosing:
+                node = nodes[enclosing[0][1]]
+                if node.comments is None:
+                    node.comments = [comment]
+                else:
+                    node.comments.append(comment)
+            elif first_end is not None:
+                node = nodes[first_end[1]]
+                if node.pre_comments is None:
+                    node.pre_comments = [comment]
+                else:
+                    node.pre_comments.append(comment)
+            else:
+                # Now we try to attach the comment to nodes that are after it
+                after = bisect.bisect_right(starts, comment_end)
+                assert after > 0
+                after = bisect.bisect_left(starts, starts[after - 1])
+                node = nodes[order[after]]
+                if node.post_comments is None:
+                    node.post_comments = [comment]
+                else:
+                    node.post_comments.append(comment)
 
     def statement(self) -> BaseNode:
-        self.begin()
-        e = self.e1()
-        self.end(e)
-        return e
+        return self.e1()
 
     def e1(self) -> BaseNode:
-        self.begin()
+        start = self.current
         left = self.e2()
         if self.accept('plusassign'):
             value = self.e1()
@@ -660,7 +915,7 @@ class Parser:
                 raise ParseException('Plusassignment target must be an id.', self.getline(), left.lineno, left.colno)
             assert isinstance(left.value, str)
             e = PlusAssignmentNode(left.filename, left.lineno, left.colno, left.value, value)
-            self.end(e)
+            self.set_span(e, start)
             return e
         elif self.accept('assign'):
             value = self.e1()
@@ -669,7 +924,7 @@ class Parser:
                                      self.getline(), left.lineno, left.colno)
             assert isinstance(left.value, str)
             f = AssignmentNode(left.filename, left.lineno, left.colno, left.value, value)
-            self.end(f)
+            self.set_span(f, start)
             return f
         elif self.accept('questionmark'):
             if self.in_ternary:
@@ -681,120 +936,119 @@ class Parser:
             falseblock = self.e1()
             self.in_ternary = False
             g = TernaryNode(left, trueblock, falseblock)
-            self.end(g)
+            self.set_span(g, start)
             return g
-        self.end(left)
+        self.set_span(left, start)
         return left
 
     def e2(self) -> BaseNode:
-        self.begin()
-        left = self.e3()
-        started = False
-        while self.accept('or'):
-            started = True
-            if isinstance(left, EmptyNode):
-                raise ParseException('Invalid or clause.',
-                                     self.getline(), left.lineno, left.colno)
-            x1 = OrNode(left, self.e3())
-            self.end(x1)
-            left = x1
-            started = False
-            self.begin()
-        if not started:
-            self.end(left)
-        return left
-
-    def e3(self) -> BaseNode:
-        self.begin()
-        left = self.e4()
-        started = False
-        while self.accept('and'):
-            if isinstance(left, EmptyNode):
-                raise ParseException('Invalid and clause.',
-                                     self.getline(), left.lineno, left.colno)
-            x1 = AndNode(left, self.e4())
-            self.end(x1)
-            left = x1
-            started = False
-            self.begin()
-        if not started:
-            self.end(left)
-        return left
-
-    def e4(self) -> BaseNode:
-        self.begin()
-        left = self.e5()
-        for nodename, operator_type in comparison_map.items():
-            if self.accept(nodename):
-                x = ComparisonNode(operator_type, left, self.e5())
-                self.end(x)
-                return x
-        if self.accept('not') and self.accept('in'):
-            x = ComparisonNode('notin', left, self.e5())
-            self.end(x)
-            return x
-        self.end(left)
-        return left
-
-    def e5(self) -> BaseNode:
-        return self.e5addsub()
-
-    def e5addsub(self) -> BaseNode:
-        self.begin()
-        op_map = {
-            'plus': 'add',
-            'dash': 'sub',
-        }
-        left = self.e5muldiv()
-        while True:
-            op = self.accept_any(tuple(op_map.keys()))
-            if op:
-                x1 = ArithmeticNode(op_map[op], left, self.e5muldiv())
-                self.end(x1)
-                left = x1
-                self.begin()
-            else:
-                break
-        self.end(left)
-        return left
-
-    def e5muldiv(self) -> BaseNode:
-        self.begin()
-        op_map = {
-            'percent': 'mod',
-            'star': 'mul',
-            'fslash': 'div',
-        }
+        return self.binary_expression(_OR_LEVEL)
+
+    def binary_expression(self, min_level: int) -> BaseNode:
+        # Precedence climbing over the binary operators of min_level and up.
+        # This used to be one method per level, so every operand went through
+        # all of them. Now the levels without an operator following the operand
+        # are skipped. The spans are set exactly like those methods did. That
+        # includes their quirks: an operator chain ends with an empty span,
+        # except where a lower level ends it again, which spans it from the
+        # start of the operand.
+        start = self.current
         left = self.e6()
-        while True:
-            op = self.accept_any(tuple(op_map.keys()))
-            if op:
-                x1 = ArithmeticNode(op_map[op], left, self.e6())
-                self.end(x1)
-                left = x1
-                self.begin()
-            else:
+        # Whether left's span still has to be extended back to start
+        reset = False
+        level = _MULDIV_LEVEL
+        while level >= min_level:
+            tid = self.current.tid
+            op_level = _BINARY_LEVELS.get(tid)
+            if op_level is None or op_level < min_level or op_level > level:
+                # No operator for any of the remaining levels, which still end
+                # the expression.
+                if reset:
+                    self.set_span(left, start)
                 break
-        self.end(left)
+            if op_level != level:
+                # This level doesn't continue the expression, but still ends it
+                if reset:
+                    self.set_span(left, start)
+                    reset = False
+                level -= 1
+                continue
+            if level == _COMPARISON_LEVEL:
+                self.getsym()
+                if tid != 'not':
+                    left = ComparisonNode(comparison_map[tid], left, self.binary_expression(_ADDSUB_LEVEL))
+                elif self.accept('in'):
+                    left = ComparisonNode('notin', left, self.binary_expression(_ADDSUB_LEVEL))
+                self.set_span(left, start)
+                reset = False
+            else:
+                span_start = start
+                # The level of the first operator is already known
+                while True:
+                    self.getsym()
+                    if level in _LOGICAL_LEVELS:
+                        if isinstance(left, EmptyNode):
+                            raise ParseException('Invalid or clause.' if level == _OR_LEVEL else 'Invalid and clause.',
+                                                 self.getline(), left.lineno, left.colno)
+                        if level == _OR_LEVEL:
+                            left = OrNode(left, self.binary_expression(_AND_LEVEL))
+                        else:
+                            left = AndNode(left, self.binary_expression(_COMPARISON_LEVEL))
+                    elif level == _ADDSUB_LEVEL:
+                        left = ArithmeticNode(_ARITHMETIC_OPS[tid], left, self.binary_expression(_MULDIV_LEVEL))
+                    else:
+                        left = ArithmeticNode(_ARITHMETIC_OPS[tid], left, self.e6())
+                    self.set_span(left, span_start)
+                    span_start = self.current
+                    tid = self.current.tid
+                    if _BINARY_LEVELS.get(tid) != level:
+                        break
+                left.bytespan = (self.current.bytespan[0], self.current.bytespan[0])
+                reset = True
+            level -= 1
         return left
 
     def e6(self) -> BaseNode:
-        self.begin()
-        if self.accept('not'):
-            x = NotNode(self.current, self.e7())
-            self.end(x)
-            return x
-        if self.accept('dash'):
-            x1 = UMinusNode(self.current, self.e7())
-            self.end(x1)
-            return x1
-        x2 = self.e7()
-        self.end(x2)
-        return x2
+        start = self.current
+        tid = start.tid
+        if tid == 'not':
+            self.getsym()
+            x = NotNode(self.current, self.e7())  # type: BaseNode
+        elif tid == 'dash':
+            self.getsym()
+            x = UMinusNode(self.current, self.e7())
+        else:
+            # e7 has usually set this span already, but after a method call
+            # or index it only starts at the last of them.
+            x = self.e7()
+        self.set_span(x, start)
+        return x
 
     def e7(self) -> BaseNode:
-        self.begin()
-        left = self.e8()
+        # The bracketed operands used to be parsed by a separate method, and
+        # tried one after another, which cost several calls for every operand.
+        start = self.current
+        tid = start.tid
+        if tid == 'lparen':
+            self.getsym()
+            e = self.statement()
+            self.block_expect('rparen', start)
+            left = ParenthesizedNode(e, start.lineno, start.colno, self.current.lineno, self.current.colno)  # type: BaseNode
+            self.set_span(left, start)
+        elif tid == 'lbracket':
+            self.getsym()
+            args = self.args()
+            self.block_expect('rbracket', start)
+            left = ArrayNode(args, start.lineno, start.colno, self.current.lineno, self.current.colno)
+            self.set_span(left, start)
+        elif tid == 'lcurl':
+            self.getsym()
+            key_values = self.key_values()
+            self.block_expect('rcurl', start)
+            left = DictNode(key_values, start.lineno, start.colno, self.current.lineno, self.current.colno)
+            self.set_span(left, start)
+        else:
+            left = self.e9()
         block_start = self.current
         if self.accept('lparen'):
             args = self.args()
@@ -804,166 +1058,129 @@ class Parser:
                                      self.getline(), left.lineno, left.colno)
             assert isinstance(left.value, str)
             x1 = FunctionNode(left.filename, left.lineno, left.colno, self.current.lineno, self.current.colno, left.value, args)
-            self.end(left)
+            self.set_span(left, start)
             left = x1
-            self.begin()
-        go_again = True
-        while go_again:
-            go_again = False
-            if self.accept('dot'):
-                go_again = True
-                x2 = self.method_call(left)
-                self.end(left)
-                left = x2
-                self.begin()
-            if self.accept('lbracket'):
-                go_again = True
-                x3 = self.index_call(left)
-                self.end(left)
-                left = x3
-                self.begin()
-        self.end(left)
+            start = self.current
+        while True:
+            tid = self.current.tid
+            if tid == 'dot':
+                self.getsym()
+                x2 = self.method_call(left)  # type: BaseNode
+            elif tid == 'lbracket':
+                self.getsym()
+                x2 = self.index_call(left)
+            else:
+                break
+            self.set_span(left, start)
+            left = x2
+            start = self.current
+        self.set_span(left, start)
         return left
 
-    def e8(self) -> BaseNode:
-        self.begin()
-        block_start = self.current
-        if self.accept('lparen'):
-            e = self.statement()
-            self.block_expect('rparen', block_start)
-            e1 = ParenthesizedNode(e, block_start.lineno, block_start.colno, self.current.lineno, self.current.colno)
-            self.end(e1)
-            return e1
-        elif self.accept('lbracket'):
-            args = self.args()
-            self.block_expect('rbracket', block_start)
-            x1 = ArrayNode(args, block_start.lineno, block_start.colno, self.current.lineno, self.current.colno)
-            self.end(x1)
-            return x1
-        elif self.accept('lcurl'):
-            key_values = self.key_values()
-            self.block_expect('rcurl', block_start)
-            x2 = DictNode(key_values, block_start.lineno, block_start.colno, self.current.lineno, self.current.colno)
-            self.end(x2)
-            return x2
-        else:
-            x3 = self.e9()
-            self.end(x3)
-            return x3
-
     def e9(self) -> BaseNode:
-        self.begin()
         t = self.current
-        if self.accept('true'):
-            t.value = True
-            x1 = BooleanNode(t)
-            self.end(x1)
-            return x1
-        if self.accept('false'):
-            t.value = False
-            x2 = BooleanNode(t)
-            self.end(x2)
-            return x2
-        if self.accept('id'):
-            x3 = IdNode(t)
-            self.end(x3)
-            return x3
-        if self.accept('number'):
-            x4 = NumberNode(t)
-            self.end(x4)
-            return x4
-        if self.accept('string'):
-            x5 = StringNode(t)
-            self.end(x5)
-            return x5
-        if self.accept('fstring'):
-            x6 = FormatStringNode(t)
-            self.end(x6)
-            return x6
-        if self.accept('multiline_fstring'):
-            x7 = MultilineFormatStringNode(t)
-            self.end(x7)
-            return x7
-        x8 = EmptyNode(self.current.lineno, self.current.colno, self.current.filename)
-        self.end(x8)
-        return x8
+        node_type = _LEAF_NODES.get(t.tid)
+        if node_type is not None:
+            self.getsym()
+            x = node_type(t)  # type: BaseNode
+        else:
+            x = EmptyNode(t.lineno, t.colno, t.filename)
+        self.set_span(x, t)
+        return x
 
     def key_values(self) -> ArgumentNode:
-        self.begin()
+        start = self.current
         s = self.statement()  # type: BaseNode
         a = ArgumentNode(self.current)
-
-        while not isinstance(s, EmptyNode):
-            if self.accept('colon'):
-                a.set_kwarg_no_check(s, self.statement())
+        commas = a.commas
+        getsym = self.getsym
+        statement = self.statement
+
+        while type(s) is not EmptyNode:
+            if self.current.tid == 'colon':
+                getsym()
+                a.set_kwarg_no_check(s, statement())
                 potential = self.current
-                if not self.accept('comma'):
-                    self.end(a)
+                if potential.tid != 'comma':
+                    self.set_span(a, start)
                     return a
-                a.commas.append(potential)
+                getsym()
+                commas.append(potential.bytespan[0])
             else:
                 raise ParseException('Only key:value pairs are valid in dict construction.',
                                      self.getline(), s.lineno, s.colno)
-            s = self.statement()
-        self.end(a)
+            s = statement()
+        self.set_span(a, start)
         return a
 
     def args(self) -> ArgumentNode:
-        self.begin()
+        start = self.current
         s = self.statement()  # type: BaseNode
         a = ArgumentNode(self.current)
-
-        while not isinstance(s, EmptyNode):
+        commas = a.commas
+        append = a.append
+        getsym = self.getsym
+        statement = self.statement
+
+        # Each argument is followed by a comma, a colon or the end of the
+        # arguments, so look at the token once to decide which.
+        while type(s) is not EmptyNode:
             potential = self.current
-            if self.accept('comma'):
-                a.commas.append(potential)
-                a.append(s)
-            elif self.accept('colon'):
+            tid = potential.tid
+            if tid == 'comma':
+                getsym()
+                commas.append(potential.bytespan[0])
+                append(s)
+            elif tid == 'colon':
+                getsym()
                 if not isinstance(s, IdNode):
                     raise ParseException('Dictionary key must be a plain identifier.',
                                          self.getline(), s.lineno, s.colno)
-                a.set_kwarg(s, self.statement())
+                a.set_kwarg(s, statement())
                 potential = self.current
-                if not self.accept('comma'):
-                    self.end(a)
+                if potential.tid != 'comma':
+                    self.set_span(a, start)
                     return a
-                a.commas.append(potential)
+                getsym()
+                commas.append(potential.bytespan[0])
             else:
-                a.append(s)
-                self.end(a)
+                append(s)
+                self.set_span(a, start)
                 return a
-            s = self.statement()
-        self.end(a)
+            s = statement()
+        self.set_span(a, start)
         return a
 
     def method_call(self, source_object: BaseNode) -> MethodNode:
-        self.begin()
-        methodname = self.e9()
-        if not isinstance(methodname, IdNode):
-            raise ParseException('Method name must be plain id',
-                                 self.getline(), self.current.lineno, self.current.colno)
-        assert isinstance(methodname.value, str)
-        self.expect('lparen')
-        args = self.args()
-        self.expect('rparen')
-        method = MethodNode(methodname.filename, methodname.lineno, methodname.colno, source_object, methodname.value, args)
-        if self.accept('dot'):
-            x1 = self.method_call(method)
-            self.end(x1)
-            return x1
-        self.end(method)
+        start = self.current
+        # Each call of a chain is the source object of the next one. Only the
+        # last one gets a span, which starts at the first method name.
+        while True:
+            methodname = self.e9()
+            if not isinstance(methodname, IdNode):
+                raise ParseException('Method name must be plain id',
+                                     self.getline(), self.current.lineno, self.current.colno)
+            assert isinstance(methodname.value, str)
+            self.expect('lparen')
+            args = self.args()
+            self.expect('rparen')
+            method = MethodNode(methodname.filename, methodname.lineno, methodname.colno, source_object, methodname.value, args)
+            if not self.accept('dot'):
+                break
+            source_object = method
+        self.set_span(method, start)
         return method
 
     def index_call(self, source_object: BaseNode) -> IndexNode:
-        self.begin()
+        start = self.current
         index_statement = self.statement()
         self.expect('rbracket')
         x1 = IndexNode(source_object, index_statement)
-        self.end(x1)
+        self.set_span(x1, start)
         return x1
 
     def foreachblock(self) -> ForeachClauseNode:
-        self.begin()
+        start = self.current
         t = self.current
         self.expect('id')
         assert isinstance(t.value, str)
@@ -980,80 +1197,83 @@ class Parser:
         items = self.statement()
         block = self.codeblock()
         x1 = ForeachClauseNode(varname, varnames, items, block)
-        self.end(x1)
+        self.set_span(x1, start)
         return x1
 
     def ifblock(self) -> IfClauseNode:
-        self.begin()
+        start = self.current
         condition = self.statement()
         clause = IfClauseNode(condition)
         self.expect('eol')
         block = self.codeblock()
-        self.begin()
+        if_start = self.current
         i = IfNode(clause, condition, block)
-        self.end(i)
+        self.set_span(i, if_start)
         clause.ifs.append(i)
         self.elseifblock(clause)
         clause.elseblock = self.elseblock()
-        self.end(clause)
+        self.set_span(clause, start)
         return clause
 
     def elseifblock(self, clause: IfClauseNode) -> None:
         while self.accept('elif'):
-            self.begin()
+            start = self.current
             s = self.statement()
             self.expect('eol')
             b = self.codeblock()
             x1 = IfNode(s, s, b)
-            self.end(x1)
+            self.set_span(x1, start)
             clause.ifs.append(x1)
 
     def elseblock(self) -> T.Union[CodeBlockNode, EmptyNode]:
         if self.accept('else'):
             self.expect('eol')
             return self.codeblock()
-        self.begin()
+        start = self.current
         x1 = EmptyNode(self.current.lineno, self.current.colno, self.current.filename)
-        self.end(x1)
+        self.set_span(x1, start)
         return x1
 
     def line(self) -> BaseNode:
         block_start = self.current
-        self.begin()
-        if self.current == 'eol':
-            x1 = EmptyNode(self.current.lineno, self.current.colno, self.current.filename)
-            self.end(x1)
-            return x1
         if self.accept('if'):
             ifblock = self.ifblock()
             self.block_expect('endif', block_start)
-            self.end(ifblock)
+            self.set_span(ifblock, block_start)
             return ifblock
         if self.accept('foreach'):
             forblock = self.foreachblock()
             self.block_expect('endforeach', block_start)
-            self.end(forblock)
+            self.set_span(forblock, block_start)
             return forblock
         if self.accept('continue'):
             x2 = ContinueNode(self.current)
-            self.end(x2)
+            self.set_span(x2, block_start)
             return x2
         if self.accept('break'):
             x3 = BreakNode(self.current)
-            self.end(x3)
+            self.set_span(x3, block_start)
             return x3
-        s = self.statement()
-        self.end(s)
-        return s
+        return self.statement()
 
     def codeblock(self) -> CodeBlockNode:
-        self.begin()
+        start = self.current
         block = CodeBlockNode(self.current)
-        cond = True
-        while cond:
-            curline = self.line()
-            if not isinstance(curline, EmptyNode):
-                block.lines.append(curline)
-            cond = self.accept('eol')
-        self.end(block)
+        append = block.lines.append
+        line = self.line
+        accept = self.accept
+        while True:
+            t = self.current
+            if t.tid == 'eol':
+                # A blank line. Its node isn't part of the block, but comments
+                # can still be attached to it.
+                self.set_span(EmptyNode(t.lineno, t.colno, t.filename), t)
+                self.getsym()
+                continue
+            curline = line()
+            if type(curline) is not EmptyNode:
+                append(curline)
+            if not accept('eol'):
+                break
+        self.set_span(block, start)
         return block
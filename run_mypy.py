@@ -23,6 +23,7 @@ modules = [
 
     # specific files
     'mesonbuild/arglist.py',
+    'mesonbuild/ast/formatter2.py',
     'mesonbuild/backend/backends.py',
     # 'mesonbuild/coredata.py',
     'mesonbuild/depfile.py',
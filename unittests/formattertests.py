@@ -13,11 +13,18 @@
 # limitations under the License.
 
 import mesonbuild.mparser
+from mesonbuild import mfmt
 from mesonbuild.ast import AstFormatter
 
-
+from pathlib import Path
+from unittest import mock
+import argparse
+import contextlib
+import io
 import os
+import shutil
 import sys
+import tempfile
 import typing as T
 import unittest
 
@@ -112,3 +119,131 @@ class FormatterTests(unittest.TestCase):
         formatter.end()
         return (formatter, old_lines)
     
+
+class FormatterCacheTests(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': str(self.tmpdir / 'cache')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = self.tmpdir / 'cache' / 'meson' / 'fmt'
+        self.output = self.tmpdir / 'out.build'
+
+    def format(self, code: str, cache: bool = True, config: T.Optional[str] = None) -> str:
+        options = argparse.Namespace(config=config, inplace=False, cache=cache)
+        mfmt.format_code(options, 'meson.build', str(self.output), code)
+        return self.output.read_text(encoding='utf-8')
+
+    def entries(self) -> T.List[str]:
+        if not self.cache.is_dir():
+            return []
+        return sorted(os.listdir(self.cache))
+
+    def test_miss_then_hit(self):
+        formatted = self.format("project('x')\nx=[1,2]\n")
+        entries = self.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual((self.cache / entries[0]).read_text(encoding='utf-8'), formatted)
+        with mock.patch.object(mfmt, 'format_uncached', side_effect=AssertionError('cache not used')):
+            self.assertEqual(self.format("project('x')\nx=[1,2]\n"), formatted)
+        self.assertEqual(self.entries(), entries)
+
+    def test_invalidation(self):
+        code = "project('x')\nx=[1,2]\n"
+        self.format(code)
+        self.format(code + 'y = 1\n')
+        self.assertEqual(len(self.entries()), 2)
+
+        # A different configuration or formatter doesn't reuse the entries
+        config = self.tmpdir / 'meson.format'
+        config.write_text('space_array = true\n', encoding='utf-8')
+        self.assertEqual(self.format(code, config=str(config)), "project('x')\nx = [ 1, 2 ]\n\n")
+        self.assertEqual(len(self.entries()), 3)
+        with mock.patch.object(mfmt, 'formatter_digest', return_value=b'changed'):
+            self.format(code)
+        self.assertEqual(len(self.entries()), 4)
+
+    def test_disabled_by_default(self):
+        code = "project('x')\nx=[1,2]\n"
+        self.format(code, cache=False)
+        self.assertEqual(self.entries(), [])
+
+        # Existing entries are not used either
+        formatted = self.format(code)
+        (self.cache / self.entries()[0]).write_text('stale\n', encoding='utf-8')
+        self.assertEqual(self.format(code, cache=False), formatted)
+
+    def test_failed_write_leaves_nothing(self):
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            formatted = self.format("project('x')\n")
+        self.assertEqual(formatted, "project('x')\n\n")
+        self.assertEqual(self.entries(), [])
+
+    def test_eviction(self):
+        with mock.patch.object(mfmt, 'CACHE_MAX_ENTRIES', 2):
+            self.format('a = 1\n')
+            first = self.entries()
+            os.utime(self.cache / first[0], (1, 1))
+            self.format('b = 1\n')
+            self.format('c = 1\n')
+            entries = self.entries()
+            self.assertEqual(len(entries), 2)
+            self.assertNotIn(first[0], entries)
+
+            # Reading an entry keeps it in the cache
+            for entry in entries:
+                os.utime(self.cache / entry, (1, 1))
+            self.format('b = 1\n')
+            self.format('d = 1\n')
+            self.assertIn(mfmt.cache_path('b = 1\n', mfmt.parse_fmt_config(None)).name, self.entries())
+
+class RecursiveFormatTests(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
+        self.source = self.tmpdir / 'source'
+        for i in range(20):
+            d = self.source / f'sub{i}'
+            d.mkdir(parents=True)
+            (d / 'meson.build').write_text(
+                f"x{i}=[1,2,{i}]\nif x{i}.length()>{i} # check\n  y=f('a',b:{i})\nendif\n", encoding='utf-8')
+        (self.source / 'meson.build').write_text("project('x')\nsubdir('sub0')\n", encoding='utf-8')
+        (self.source / 'sub7' / 'meson.build').write_text('x = [\n', encoding='utf-8')
+
+    def format_tree(self, name: str) -> T.Tuple[T.Dict[str, str], T.List[str]]:
+        root = self.tmpdir / name
+        shutil.copytree(self.source, root)
+        options = argparse.Namespace(file=str(root), recurse=True, inplace=False, output=None,
+                                     config=None, cache=False)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertEqual(mfmt.run(options), 0)
+        files = {str(p.relative_to(root)): p.read_text(encoding='utf-8') for p in root.rglob('meson.build')}
+        errors = sorted(stderr.getvalue().replace(str(root), '').splitlines())
+        return files, errors
+
+    def test_parallel_matches_serial(self):
+        with mock.patch('os.cpu_count', return_value=1):
+            serial = self.format_tree('serial')
+        with mock.patch('os.cpu_count', return_value=4), \
+                mock.patch.object(mfmt, 'ProcessPoolExecutor', wraps=mfmt.ProcessPoolExecutor) as pool:
+            parallel = self.format_tree('parallel')
+        pool.assert_called_once()
+        self.assertEqual(parallel, serial)
+        files, errors = serial
+        self.assertEqual(files[os.path.join('sub7', 'meson.build')], 'x = [\n')
+        self.assertNotEqual(files[os.path.join('sub3', 'meson.build')],
+                            (self.source / 'sub3' / 'meson.build').read_text(encoding='utf-8'))
+        self.assertTrue(any('Unable to format' in e for e in errors), errors)
+
+    def test_frozen_is_serial(self):
+        with mock.patch('os.cpu_count', return_value=4), \
+                mock.patch.object(sys, 'frozen', True, create=True), \
+                mock.patch.object(mfmt, 'ProcessPoolExecutor', side_effect=AssertionError('uses processes')):
+            files, _ = self.format_tree('frozen')
+        self.assertEqual(len(files), 21)
@@ -24,6 +24,7 @@ import pickle
 import stat
 import subprocess
 import tempfile
+import textwrap
 import typing as T
 import unittest
 
@@ -34,7 +35,7 @@ import mesonbuild.dependencies.factory
 import mesonbuild.envconfig
 import mesonbuild.environment
 import mesonbuild.modules.gnome
-from mesonbuild import coredata
+from mesonbuild import coredata, mparser
 from mesonbuild.compilers.c import ClangCCompiler, GnuCCompiler
 from mesonbuild.compilers.d import DmdDCompiler
 from mesonbuild.interpreterbase import typed_pos_args, InvalidArguments, ObjectHolder
@@ -1623,3 +1624,192 @@ class InternalTests(unittest.TestCase):
         for raw, expected in cases:
             with self.subTest(raw):
                 self.assertEqual(OptionKey.from_string(raw), expected)
+
+    def _parse_expression(self, code: str) -> mparser.BaseNode:
+        return mparser.Parser(code, 'meson.build').parse().lines[0]
+
+    def _expression_tree(self, node: mparser.BaseNode) -> str:
+        if isinstance(node, (mparser.OrNode, mparser.AndNode)):
+            op = 'or' if isinstance(node, mparser.OrNode) else 'and'
+            return f'({op} {self._expression_tree(node.left)} {self._expression_tree(node.right)})'
+        if isinstance(node, mparser.ComparisonNode):
+            return f'({node.ctype} {self._expression_tree(node.left)} {self._expression_tree(node.right)})'
+        if isinstance(node, mparser.ArithmeticNode):
+            return f'({node.operation} {self._expression_tree(node.left)} {self._expression_tree(node.right)})'
+        if isinstance(node, mparser.NotNode):
+            return f'(not {self._expression_tree(node.value)})'
+        if isinstance(node, mparser.UMinusNode):
+            return f'(neg {self._expression_tree(node.value)})'
+        if isinstance(node, mparser.ParenthesizedNode):
+            return self._expression_tree(node.inner)
+        assert isinstance(node, (mparser.IdNode, mparser.NumberNode)), node
+        return str(node.value)
+
+    def test_parser_binary_operators(self) -> None:
+        cases = [
+            ('a or b or c', '(or (or a b) c)'),
+            ('a and b and c', '(and (and a b) c)'),
+            ('a or b and c', '(or a (and b c))'),
+            ('a and b or c and d', '(or (and a b) (and c d))'),
+            ('a and b == c', '(and a (== b c))'),
+            ('a == b or c != d', '(or (== a b) (!= c d))'),
+            ('a < b + c', '(< a (add b c))'),
+            ('a in b and c not in d', '(and (in a b) (notin c d))'),
+            ('a - b - c', '(sub (sub a b) c)'),
+            ('a + b - c + d', '(add (sub (add a b) c) d)'),
+            ('a / b % c * d', '(mul (mod (div a b) c) d)'),
+            ('a + b * c', '(add a (mul b c))'),
+            ('a * b + c * d', '(add (mul a b) (mul c d))'),
+            ('a * b - c / d + e', '(add (sub (mul a b) (div c d)) e)'),
+            ('-a * b', '(mul (neg a) b)'),
+            ('a - -b', '(sub a (neg b))'),
+            ('not a and b', '(and (not a) b)'),
+            ('not a == b', '(== (not a) b)'),
+            ('(a or b) and c', '(and (or a b) c)'),
+            ('a * (b + c)', '(mul a (add b c))'),
+            ('a or b and c == d + e * -f', '(or a (and b (== c (add d (mul e (neg f))))))'),
+            ('a * b + c == d and e or f', '(or (and (== (add (mul a b) c) d) e) f)'),
+        ]
+        for code, expected in cases:
+            with self.subTest(code):
+                self.assertEqual(self._expression_tree(self._parse_expression(code)), expected)
+
+    def test_parser_logical_operators_need_left_operand(self) -> None:
+        for code, message in (('or a', 'Invalid or clause.'),
+                              ('and a', 'Invalid and clause.'),
+                              ('x = or b', 'Invalid or clause.')):
+            with self.subTest(code):
+                with self.assertRaisesRegex(mparser.ParseException, message):
+                    self._parse_expression(code)
+
+    def test_parser_node_spans(self) -> None:
+        def position(node: mparser.BaseNode) -> T.Tuple[int, int, int, int, T.Tuple[int, int]]:
+            return (node.lineno, node.colno, node.end_lineno, node.end_colno, node.bytespan)
+
+        code = textwrap.dedent('''\
+            x = a or b and not c
+            y = (1 + 2) * -3 - 4
+            if x.f(y)[0] in [1, 2]
+              z = {'k': y}
+            endif
+            ''')
+        block = mparser.Parser(code, 'meson.build').parse()
+        self.assertEqual(len(block.lines), 3)
+
+        # The spans of operator chains are quirky, but comment attachment
+        # depends on them, so they must not change.
+        assign = block.lines[0]
+        self.assertEqual(position(assign), (1, 0, 1, 0, (0, 20)))
+        self.assertEqual(position(assign.value), (1, 4, 1, 4, (4, 20)))
+        self.assertEqual(position(assign.value.left), (1, 4, 1, 4, (4, 6)))
+        self.assertEqual(position(assign.value.right), (1, 9, 1, 9, (20, 20)))
+        self.assertEqual(position(assign.value.right.left), (1, 9, 1, 9, (9, 11)))
+        self.assertEqual(position(assign.value.right.right), (1, 19, 1, 19, (15, 20)))
+        self.assertEqual(position(assign.value.right.right.value), (1, 19, 1, 19, (19, 20)))
+
+        assign = block.lines[1]
+        self.assertEqual(position(assign), (2, 0, 2, 0, (21, 41)))
+        sub = assign.value
+        self.assertEqual(position(sub), (2, 4, 2, 4, (25, 41)))
+        self.assertEqual(position(sub.left), (2, 4, 2, 4, (38, 38)))
+        self.assertEqual(position(sub.left.left), (2, 4, 2, 12, (25, 33)))
+        self.assertEqual(position(sub.left.left.inner), (2, 5, 2, 5, (26, 31)))
+        self.assertEqual(position(sub.left.left.inner.left), (2, 5, 2, 5, (26, 28)))
+        self.assertEqual(position(sub.left.left.inner.right), (2, 9, 2, 9, (30, 31)))
+        self.assertEqual(position(sub.left.right), (2, 15, 2, 15, (35, 38)))
+        self.assertEqual(position(sub.left.right.value), (2, 15, 2, 15, (36, 38)))
+        self.assertEqual(position(sub.right), (2, 19, 2, 19, (40, 41)))
+
+        clause = block.lines[2]
+        self.assertEqual(position(clause), (3, 5, 3, 5, (42, 85)))
+        self.assertEqual(position(clause.ifs[0]), (3, 5, 3, 5, (80, 80)))
+        comparison = clause.ifs[0].condition
+        self.assertEqual(position(comparison), (3, 5, 3, 5, (45, 64)))
+        self.assertEqual(position(comparison.left), (3, 5, 3, 5, (45, 55)))
+        method = comparison.left.iobject
+        self.assertEqual(position(method), (3, 5, 3, 5, (51, 55)))
+        self.assertEqual(position(method.source_object), (3, 3, 3, 3, (45, 51)))
+        self.assertEqual(position(method.args), (3, 8, 3, 8, (49, 50)))
+        self.assertEqual(position(comparison.left.index), (3, 10, 3, 10, (52, 53)))
+        self.assertEqual(position(comparison.right), (3, 16, 3, 22, (58, 64)))
+        self.assertEqual(position(comparison.right.args), (3, 18, 3, 18, (59, 63)))
+        body = clause.ifs[0].block
+        self.assertEqual(position(body), (4, 2, 4, 2, (67, 80)))
+        self.assertEqual(position(body.lines[0]), (4, 2, 4, 2, (67, 79)))
+        self.assertEqual(position(body.lines[0].value), (4, 6, 4, 14, (71, 79)))
+        self.assertEqual(position(clause.elseblock), (5, 0, 5, 0, (80, 80)))
+
+    def _attached_comments(self, code: str) -> T.Tuple[mparser.CodeBlockNode, T.Dict[str, T.Tuple[str, mparser.BaseNode]]]:
+        parser = mparser.Parser(code, 'meson.build')
+        block = parser.parse()
+        attached = {}  # type: T.Dict[str, T.Tuple[str, mparser.BaseNode]]
+        for node in parser.nodes:
+            for kind in ('pre_comments', 'comments', 'post_comments'):
+                for comment in getattr(node, kind) or []:
+                    self.assertEqual(attached.setdefault(comment.text, (kind, node)), (kind, node), comment.text)
+        self.assertEqual(sorted(attached), sorted(c.text for c in parser.lexer.comments))
+        return block, attached
+
+    def test_parser_comments_around_arguments(self) -> None:
+        code = textwrap.dedent('''\
+            f( # open
+              a, # after a
+              # before b
+              b, c # after c
+              # before close
+            )
+            ''')
+        block, attached = self._attached_comments(code)
+        args = block.lines[0].args
+        kind, node = attached['# open']
+        self.assertEqual(kind, 'comments')
+        self.assertIsInstance(node, mparser.IdNode)
+        self.assertEqual(node.value, 'f')
+        self.assertEqual(attached['# after a'], ('comments', args))
+        self.assertEqual(attached['# before b'], ('comments', args))
+        self.assertEqual(attached['# after c'], ('comments', args.arguments[2]))
+        self.assertEqual(attached['# before close'], ('comments', args.arguments[2]))
+
+    def test_parser_comment_at_eof(self) -> None:
+        block, attached = self._attached_comments('x = 1\n# trailing\n')
+        kind, node = attached['# trailing']
+        self.assertEqual(kind, 'pre_comments')
+        self.assertIsInstance(node, mparser.EmptyNode)
+        self.assertEqual(block.lines[0].value.comments, None)
+
+        _, attached = self._attached_comments('# only\n')
+        kind, node = attached['# only']
+        self.assertEqual(kind, 'comments')
+        self.assertIsInstance(node, mparser.EmptyNode)
+
+    def test_parser_comments_in_empty_containers(self) -> None:
+        code = textwrap.dedent('''\
+            x = [ # in array
+            ]
+            y = { # in dict
+            }
+            z = [
+              # alone
+            ]
+            ''')
+        block, attached = self._attached_comments(code)
+        self.assertEqual(attached['# in array'], ('comments', block.lines[0].value))
+        self.assertEqual(attached['# in dict'], ('comments', block.lines[1].value))
+        self.assertEqual(attached['# alone'], ('comments', block.lines[2].value))
+
+    def test_parser_comments_on_if_lines(self) -> None:
+        code = textwrap.dedent('''\
+            if a # after if
+              b = 1
+            elif c # after elif
+              d = 2
+            else # after else
+              e = 3
+            endif # after endif
+            ''')
+        block, attached = self._attached_comments(code)
+        clause = block.lines[0]
+        self.assertEqual(attached['# after if'], ('comments', clause.ifs[0].condition))
+        self.assertEqual(attached['# after elif'], ('comments', clause.ifs[1].condition))
+        self.assertEqual(attached['# after else'], ('comments', clause))
+        self.assertEqual(attached['# after endif'], ('comments', clause))